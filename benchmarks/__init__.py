@@ -0,0 +1,5 @@
+"""
+Benchmarks, run from the repository root, e.g.
+
+  python -m benchmarks.rtf --config [config.json] --ptfile [G.pth] --device cpu
+"""
@@ -0,0 +1,106 @@
+"""
+Parity and peak memory of the WavLM attention backends.
+
+For each input length, extracts content features with every --backends entry
+and reports the median wall time, the peak memory and the max abs difference
+to the first backend (by default "default", F.multi_head_attention_forward).
+
+  python -m benchmarks.attention --wavlm_path [WavLM-Large.pt] --device cpu \
+      --lengths 10 30 60 120 --backends default sdpa chunked --out attention.json
+
+The default backend materialises batch x heads x T x T scores in every layer,
+so its peak memory grows quadratically with the length; chunked should grow
+linearly. On CPU the peak is the process RSS, which keeps pages freed by the
+backends run before: list the backend of interest first.
+
+Before timing, check_parity asserts that every backend matches the first on a
+padded batch of two unequal lengths (key padding mask together with the gated
+relative position bias, several query chunks). --skip_check skips it.
+"""
+import json
+import argparse
+
+import torch
+import numpy as np
+
+import utils.utils as utils
+from wavlm.modules import ATTENTION_BACKENDS
+from benchmarks.rtf import measure
+
+
+@torch.no_grad()
+def check_parity(cmodel, backends, device, layer=None, seconds=2.0, chunk_size=16, atol=1e-4, sampling_rate=16000):
+    """Asserts max abs difference <= atol between every backend and backends[0] on the unpadded frames of a padded batch"""
+    length = int(seconds * sampling_rate)
+    wav = torch.from_numpy(np.random.RandomState(0).randn(2, length).astype(np.float32) * 0.1).to(device)
+    padding_mask = torch.zeros(2, length, dtype=torch.bool, device=device)
+    padding_mask[1, length * 3 // 5:] = True
+    wav[padding_mask] = 0
+    layer = layer or len(cmodel.encoder.layers)
+
+    reference = None
+    for backend in backends:
+        cmodel.set_attention_backend(backend, chunk_size)
+        (c,), frame_mask = cmodel.extract_layers(wav, [layer], padding_mask=padding_mask)
+        c = c.masked_fill(frame_mask.unsqueeze(-1), 0)
+        if reference is None:
+            reference = c
+            continue
+        diff = (c - reference).abs().max().item()
+        assert diff <= atol, "{} differs from {} by {:.2e} on a padded batch".format(backend, backends[0], diff)
+    cmodel.set_attention_backend(backends[0])
+
+
+@torch.no_grad()
+def bench_length(cmodel, wav, layer, backends, chunk_size, device, repeats, warmup):
+    result, reference = {}, None
+    for backend in backends:
+        cmodel.set_attention_backend(backend, chunk_size)
+
+        def content():
+            return utils.get_content(cmodel, wav, layer=layer)
+
+        seconds, peak = measure(content, device, repeats, warmup)
+        c = content()
+        if reference is None:
+            reference = c
+        result[backend] = {
+            "seconds": seconds,
+            "peak_memory_mb": peak / 2 ** 20,
+            "max_abs_diff": (c - reference).abs().max().item(),
+        }
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wavlm_path", type=str, default="./wavlm/WavLM-Large.pt", help="path to WavLM checkpoint")
+    parser.add_argument("--layer", type=int, default=6, help="WavLM layer")
+    parser.add_argument("--device", type=str, default="cpu", help="device to benchmark on")
+    parser.add_argument("--lengths", type=float, nargs="+", default=[10, 30, 60], help="input lengths in seconds")
+    parser.add_argument("--batch_size", type=int, default=1, help="batch size")
+    parser.add_argument("--backends", type=str, nargs="+", default=list(ATTENTION_BACKENDS), help="attention backends, the first is the parity reference")
+    parser.add_argument("--chunk_size", type=int, default=256, help="query block of the chunked backend (frames)")
+    parser.add_argument("--sampling_rate", type=int, default=16000, help="input sampling rate")
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs per point, the median is reported")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed runs per point")
+    parser.add_argument("--out", type=str, default="./attention.json", help="path to output json")
+    parser.add_argument("--skip_check", default=False, action="store_true", help="skip the padded-batch parity check of the backends")
+    args = parser.parse_args()
+
+    cmodel = utils.get_cmodel(torch.device(args.device), checkpoint_path=args.wavlm_path)
+    if not args.skip_check:
+        check_parity(cmodel, args.backends, args.device, layer=args.layer)
+    results = []
+    for length in args.lengths:
+        audio = np.random.RandomState(0).randn(int(length * args.sampling_rate)).astype(np.float32) * 0.1
+        wav = torch.from_numpy(audio).unsqueeze(0).repeat(args.batch_size, 1).to(args.device)
+        row = {"length": length, "batch_size": args.batch_size}
+        row.update(bench_length(cmodel, wav, args.layer, args.backends, args.chunk_size, args.device, args.repeats, args.warmup))
+        results.append(row)
+        print("length {}s: {}".format(length, ", ".join(
+            "{} {:.3f}s {:.0f} MB diff {:.2e}".format(b, row[b]["seconds"], row[b]["peak_memory_mb"], row[b]["max_abs_diff"])
+            for b in args.backends)))
+
+    with open(args.out, "w") as f:
+        json.dump({"chunk_size": args.chunk_size, "results": results}, f, indent=2)
@@ -0,0 +1,86 @@
+"""
+Import time of the entry points (worker cold start).
+
+Imports each module in a fresh interpreter under `python -X importtime` and
+reports, over --repeats processes, the median
+
+  seconds    wall time of `import <module>` inside the process
+  packages   self import time summed per top-level package (torch, librosa, ...)
+
+The heaviest packages show what a module pulls in at import; anything heavy
+that the entry point does not use should be imported on first use. Pass
+--baseline with an earlier JSON to print the relative change of each module.
+
+  python -m benchmarks.import_time --modules inference convert server preprocess_ssl utils.audio \
+      --repeats 5 --out import_time.json
+"""
+import sys
+import json
+import argparse
+import subprocess
+from collections import defaultdict
+
+import numpy as np
+
+
+def parse_importtime(stderr):
+    """{top-level package: self import time (s)} from -X importtime output"""
+    packages = defaultdict(float)
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line[len("import time:"):].split("|")
+        packages[name.strip().split(".")[0]] += int(self_us) / 1e6
+    return packages
+
+
+def measure_module(module, python=sys.executable):
+    """Wall time (s) of importing module in a fresh interpreter and its per-package self times"""
+    code = "import time; t = time.perf_counter(); import {}; print(time.perf_counter() - t)".format(module)
+    proc = subprocess.run([python, "-X", "importtime", "-c", code], capture_output=True, text=True)
+    assert proc.returncode == 0, "import {} failed:\n{}".format(module, proc.stderr[-2000:])
+    return float(proc.stdout.strip().splitlines()[-1]), parse_importtime(proc.stderr)
+
+
+def bench_module(module, repeats, top):
+    runs = [measure_module(module) for _ in range(repeats)]
+    names = set().union(*(packages for _, packages in runs))
+    packages = {name: float(np.median([p.get(name, 0.0) for _, p in runs])) for name in names}
+    heaviest = sorted(packages.items(), key=lambda item: -item[1])[:top]
+    return {
+        "module": module,
+        "seconds": float(np.median([seconds for seconds, _ in runs])),
+        "packages": dict(heaviest),
+    }
+
+
+def compare(results, baseline_path):
+    """Relative change of the import time of each module against a baseline json"""
+    with open(baseline_path) as f:
+        baseline = {row["module"]: row for row in json.load(f)["results"]}
+    for row in results:
+        if row["module"] not in baseline:
+            continue
+        print("{}: {:+.1%}".format(row["module"], row["seconds"] / baseline[row["module"]]["seconds"] - 1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--modules", type=str, nargs="+", default=["inference", "convert", "server", "preprocess_ssl", "utils.audio"], help="modules to import")
+    parser.add_argument("--repeats", type=int, default=5, help="fresh processes per module, the median is reported")
+    parser.add_argument("--top", type=int, default=8, help="heaviest packages to report per module")
+    parser.add_argument("--out", type=str, default="./import_time.json", help="path to output json")
+    parser.add_argument("--baseline", type=str, default=None, help="earlier output json to compare against")
+    args = parser.parse_args()
+
+    results = []
+    for module in args.modules:
+        row = bench_module(module, args.repeats, args.top)
+        results.append(row)
+        print("{}: {:.3f}s ({})".format(module, row["seconds"], ", ".join(
+            "{} {:.3f}s".format(name, seconds) for name, seconds in row["packages"].items())))
+
+    with open(args.out, "w") as f:
+        json.dump({"python": sys.version, "results": results}, f, indent=2)
+    if args.baseline is not None:
+        compare(results, args.baseline)
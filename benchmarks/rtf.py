@@ -0,0 +1,194 @@
+"""
+Real-time factor of the conversion path.
+
+Sweeps utterance length x batch size x threads x precision and measures, for
+each point, the median wall time, real-time factor (seconds per second of
+source audio) and peak memory of
+
+  content    WavLM content extraction          utils.get_content
+  vq         VQ split (content / speaker)      SynthesizerTrn.split
+  generator  Generator decoding                SynthesizerTrn.dec
+  full       wav -> converted audio            get_content + SynthesizerTrn.convert
+
+Peak memory is the process RSS sampled during the stage on CPU and the peak
+allocated CUDA memory on GPU. Pass --baseline with an earlier JSON to print the
+relative change of each point.
+
+  python -m benchmarks.rtf --config [config.json] --ptfile [G.pth] --device cpu \
+      --lengths 1 5 10 30 60 --batch_sizes 1 4 --threads 1 4 --precisions fp32 bf16 --out rtf.json
+"""
+import os
+import json
+import time
+import platform
+import argparse
+import subprocess
+from glob import glob
+
+import torch
+import numpy as np
+
+import utils.utils as utils
+from utils import audio
+from utils.profiling import PeakRSS
+from inference import VoiceConverter, autocast
+
+
+STAGES = ("content", "vq", "generator", "full")
+
+
+def load_audio(wav_dir, seconds, sampling_rate, synthetic=False):
+    """(seconds * sampling_rate,) float32 array: sample wavs concatenated (and tiled) or noise"""
+    length = int(seconds * sampling_rate)
+    if synthetic:
+        return np.random.RandomState(0).randn(length).astype(np.float32) * 0.1
+    wavs = []
+    for path in sorted(glob(os.path.join(wav_dir, "*", "*.wav"))):
+        wav, _ = audio.load(path, sr=sampling_rate)
+        wavs.append(wav)
+        if sum(len(w) for w in wavs) >= length:
+            break
+    assert wavs, "no wavs in {}, use --synthetic".format(wav_dir)
+    joined = np.concatenate(wavs)
+    return np.tile(joined, length // len(joined) + 1)[:length]
+
+
+def measure(fn, device, repeats, warmup):
+    """Median wall time (s) and peak memory (bytes) of fn()"""
+    device = torch.device(device)
+    for _ in range(warmup):
+        fn()
+    times, peak = [], 0
+    for _ in range(repeats):
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+        with PeakRSS() as rss:
+            start = time.perf_counter()
+            fn()
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            times.append(time.perf_counter() - start)
+        peak = max(peak, torch.cuda.max_memory_allocated(device) if device.type == "cuda" else rss.peak)
+    return float(np.median(times)), peak
+
+
+@torch.no_grad()
+def bench_point(converter, source, batch_size, repeats, warmup):
+    device, net_g = converter.device, converter.net_g
+    wav = torch.from_numpy(source).unsqueeze(0).repeat(batch_size, 1).to(device)
+
+    def content():
+        with autocast(device, converter.precision):
+            return utils.get_content(converter.cmodel, wav, layer=converter.layer)
+
+    c = content()
+    z, g, res = net_g.split(c)
+
+    def vq():
+        with autocast(device, converter.precision):
+            return net_g.split(c)
+
+    def generator():
+        with autocast(device, converter.precision):
+            return net_g.dec(z, g=g, res=res)
+
+    def full():
+        with autocast(device, converter.precision):
+            src_c = utils.get_content(converter.cmodel, wav, layer=converter.layer)
+            return net_g.convert(src_c, g_tgt=g)
+
+    seconds_audio = batch_size * len(source) / converter.sampling_rate
+    result = {"frames": batch_size * c.size(-1)}
+    for name, fn in zip(STAGES, (content, vq, generator, full)):
+        seconds, peak = measure(fn, device, repeats, warmup)
+        result[name] = {"seconds": seconds, "rtf": seconds / seconds_audio, "peak_memory_mb": peak / 2 ** 20}
+    return result
+
+
+def environment(args):
+    try:
+        revision = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        "git_revision": revision,
+        "torch": torch.__version__,
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "cuda_device": torch.cuda.get_device_name(args.device) if torch.device(args.device).type == "cuda" else None,
+        "config": args.config,
+        "ptfile": args.ptfile,
+        "quantize": args.quantize,
+        "compile": args.compile,
+        "attention": args.attention,
+        "synthetic": args.synthetic,
+    }
+
+
+def key(row):
+    return (row["length"], row["batch_size"], row["threads"], row["precision"])
+
+
+def compare(results, baseline_path):
+    """Relative change of the rtf of each stage against a baseline json"""
+    with open(baseline_path) as f:
+        baseline = {key(row): row for row in json.load(f)["results"]}
+    for row in results:
+        if key(row) not in baseline:
+            continue
+        changes = ["{} {:+.1%}".format(stage, row[stage]["rtf"] / baseline[key(row)][stage]["rtf"] - 1) for stage in STAGES]
+        print("length {}s batch {} threads {} {}: {}".format(*key(row), ", ".join(changes)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="./config/V9_VQ256_concat_5_40000.json", help="path to json config file")
+    parser.add_argument("--ptfile", type=str, default=None, help="path to pth file, random generator weights if not given")
+    parser.add_argument("--wavlm_path", type=str, default=None, help="path to WavLM checkpoint")
+    parser.add_argument("--layer", type=int, default=6, help="WavLM layer")
+    parser.add_argument("--device", type=str, default="cpu", help="device to benchmark on")
+    parser.add_argument("--quantize", default=False, action="store_true", help="dynamic int8 WavLM content encoder (CPU only)")
+    parser.add_argument("--compile", default=False, action="store_true", help="torch.compile the generator")
+    parser.add_argument("--attention", type=str, default="default", help="WavLM attention backend: default / sdpa / chunked (long inputs)")
+    parser.add_argument("--wav_dir", type=str, default="./data_sample/VCTK", help="path to wav dir (speaker/*.wav)")
+    parser.add_argument("--synthetic", default=False, action="store_true", help="use noise instead of --wav_dir audio")
+    parser.add_argument("--lengths", type=float, nargs="+", default=[1, 5, 10, 30, 60], help="utterance lengths in seconds")
+    parser.add_argument("--batch_sizes", type=int, nargs="+", default=[1], help="batch sizes")
+    parser.add_argument("--threads", type=int, nargs="+", default=[torch.get_num_threads()], help="torch intra-op threads")
+    parser.add_argument("--precisions", type=str, nargs="+", default=["fp32"], help="fp32 / bf16 / fp16")
+    parser.add_argument("--repeats", type=int, default=3, help="timed runs per point, the median is reported")
+    parser.add_argument("--warmup", type=int, default=1, help="untimed runs per point")
+    parser.add_argument("--out", type=str, default="./rtf.json", help="path to output json")
+    parser.add_argument("--baseline", type=str, default=None, help="earlier output json to compare against")
+    args = parser.parse_args()
+
+    for precision in args.precisions:
+        assert precision in ("fp32", "bf16", "fp16"), "unknown precision {}".format(precision)
+        assert precision != "fp16" or torch.device(args.device).type == "cuda", "fp16 autocast needs a GPU"
+
+    hps = utils.get_hparams_from_file(args.config)
+    converter = VoiceConverter(hps, args.ptfile, device=args.device, quantize=args.quantize,
+                               layer=args.layer, cmodel_path=args.wavlm_path, compile=args.compile,
+                               attention=args.attention)
+
+    results = []
+    for threads in args.threads:
+        torch.set_num_threads(threads)
+        for precision in args.precisions:
+            converter.precision = precision
+            for length in args.lengths:
+                source = load_audio(args.wav_dir, length, converter.sampling_rate, args.synthetic)
+                for batch_size in args.batch_sizes:
+                    row = {"length": length, "batch_size": batch_size, "threads": threads, "precision": precision}
+                    row.update(bench_point(converter, source, batch_size, args.repeats, args.warmup))
+                    results.append(row)
+                    print(json.dumps({k: row[k] for k in ("length", "batch_size", "threads", "precision")}),
+                          " ".join("{} rtf {:.4f}".format(stage, row[stage]["rtf"]) for stage in STAGES))
+
+    with open(args.out, "w") as f:
+        json.dump({"environment": environment(args), "results": results}, f, indent=2)
+    if args.baseline is not None:
+        compare(results, args.baseline)
@@ -0,0 +1,284 @@
+"""
+Training input pipeline and step throughput, CPU only.
+
+  1. per-stage time of TextAudioSpeakerLoader (wav read, spec load, content
+     load) and TextAudioSpeakerCollate (padding + segment slicing), in process
+  2. DataLoader + DistributedBucketSampler throughput for each --num_workers:
+     samples/s, worker utilisation (busy time / (workers x wall time)) and
+     starvation (time the training loop waits for the next batch), with
+     --compute_ms of simulated step time per batch
+  3. optionally (--train_step) a synthetic CPU train step of SynthesizerTrn +
+     MultiPeriodDiscriminator for the config (D and G updates as in train.py),
+     eager and with --compile also torch.compile'd
+
+If the loader is starved at the measured step time, add workers or faster storage.
+
+  python -m benchmarks.train_throughput --config [config.json] --num_workers 0 2 4 8 --compute_ms 300
+  python -m benchmarks.train_throughput --config [config.json] --synthetic 256 --train_step
+"""
+import os
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+import torch
+import numpy as np
+from torch.nn import functional as F
+from torch.utils.data import DataLoader, Dataset
+from scipy.io.wavfile import write
+
+import utils.utils as utils
+from utils import commons
+from utils.profiling import StageTimer
+from utils.mel_processing import spectrogram_torch, spec_to_mel_torch, mel_spectrogram_torch
+from data_utils_no_trim import TextAudioSpeakerLoader, TextAudioSpeakerCollate, DistributedBucketSampler
+from models.models_v9_concat_5_40000 import SynthesizerTrn, MultiPeriodDiscriminator
+from losses import generator_loss, discriminator_loss, feature_loss
+
+
+# bucket boundaries of train.py
+BOUNDARIES = [32, 300, 400, 500, 600, 700, 800, 900, 1000]
+
+
+def make_synthetic_dataset(root, hps, num_utterances, min_seconds=1., max_seconds=6., num_speakers=4):
+    """
+    Writes the training layout expected by TextAudioSpeakerLoader under root:
+      vctk-16k/<spk>/<utt>.wav, vctk-16k/<spk>/<utt>.spec_no_trim.pt, wavlm-6L/<spk>/<utt>.pt
+    returns the filelist path
+    """
+    rng = np.random.RandomState(0)
+    paths = []
+    for i in range(num_utterances):
+        speaker = "spk{}".format(i % num_speakers)
+        wav_path = os.path.join(root, "vctk-16k", speaker, "{}_{:04d}.wav".format(speaker, i))
+        os.makedirs(os.path.dirname(wav_path), exist_ok=True)
+        os.makedirs(os.path.dirname(wav_path.replace("vctk-16k", "wavlm-6L")), exist_ok=True)
+
+        length = int(rng.uniform(min_seconds, max_seconds) * hps.data.sampling_rate)
+        wav = (rng.randn(length) * 0.1 * hps.data.max_wav_value).astype(np.int16)
+        write(wav_path, hps.data.sampling_rate, wav)
+
+        audio_norm = torch.from_numpy(wav.astype(np.float32) / hps.data.max_wav_value).unsqueeze(0)
+        spec = spectrogram_torch(audio_norm, hps.data.filter_length, hps.data.sampling_rate,
+                                 hps.data.hop_length, hps.data.win_length, center=False).squeeze(0)
+        torch.save(spec, wav_path.replace(".wav", ".spec_no_trim.pt"))
+        c = torch.randn(1, hps.model.ssl_dim, spec.size(-1))
+        torch.save(c, wav_path.replace(".wav", ".pt").replace("vctk-16k", "wavlm-6L"))
+        paths.append(wav_path)
+
+    filelist = os.path.join(root, "train.txt")
+    with open(filelist, "w") as f:
+        f.write("\n".join(paths) + "\n")
+    return filelist
+
+
+def profile_stages(dataset, collate_fn, sampler, num_batches):
+    """Per-stage time of loading and collating num_batches in this process"""
+    timer = StageTimer("cpu")
+    dataset.timer = timer
+    samples = 0
+    for i, indices in enumerate(sampler):
+        if i == num_batches:
+            break
+        batch = [dataset[j] for j in indices]
+        with timer.stage("collate"):
+            collate_fn(batch)
+        samples += len(batch)
+    dataset.timer = None
+
+    return {name: {"calls": stats["calls"], "seconds": stats["seconds"],
+                   "ms_per_sample": 1000 * stats["seconds"] / samples} for name, stats in timer.stages.items()}
+
+
+class TimedDataset(Dataset):
+    """Returns (item, fetch seconds) so that worker busy time reaches the main process"""
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __getitem__(self, index):
+        start = time.perf_counter()
+        item = self.dataset[index]
+        return item, time.perf_counter() - start
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+class TimedCollate():
+    def __init__(self, collate_fn):
+        self.collate_fn = collate_fn
+
+    def __call__(self, batch):
+        start = time.perf_counter()
+        collated = self.collate_fn([item for item, _ in batch])
+        busy = sum(seconds for _, seconds in batch) + time.perf_counter() - start
+        return collated, busy
+
+
+def profile_loader(dataset, collate_fn, sampler, num_workers, num_batches, compute_ms, starve_ms=1.):
+    """DataLoader throughput against a simulated training step of compute_ms per batch"""
+    loader = DataLoader(TimedDataset(dataset), num_workers=num_workers, shuffle=False, pin_memory=False,
+                        collate_fn=TimedCollate(collate_fn), batch_sampler=sampler,
+                        persistent_workers=False)
+    waits, busy, samples = [], 0., 0
+    start = time.perf_counter()
+    iterator = iter(loader)
+    for _ in range(num_batches):
+        wait_start = time.perf_counter()
+        try:
+            (c, spec, y), batch_busy = next(iterator)
+        except StopIteration:
+            break
+        waits.append(time.perf_counter() - wait_start)
+        busy += batch_busy
+        samples += c.size(0)
+        if compute_ms:
+            time.sleep(compute_ms / 1000)
+    wall = time.perf_counter() - start
+    del iterator
+
+    # the first wait includes worker start-up
+    steady = waits[1:] or waits
+    return {
+        "num_workers": num_workers,
+        "batches": len(waits),
+        "samples_per_second": samples / wall,
+        "worker_utilisation": busy / (max(num_workers, 1) * wall),
+        "first_batch_seconds": waits[0] if waits else None,
+        "wait_ms_mean": 1000 * float(np.mean(steady)) if steady else None,
+        "wait_ms_p95": 1000 * float(np.percentile(steady, 95)) if steady else None,
+        "starved_fraction": float(np.mean([w * 1000 > starve_ms for w in steady])) if steady else None,
+        "starved_seconds": float(np.sum(steady)),
+    }
+
+
+def profile_train_step(hps, batch, num_steps, codebook_path, compile=False):
+    """Seconds per synthetic D + G update of SynthesizerTrn + MultiPeriodDiscriminator on CPU (as train_step in train.py)"""
+    model_kwargs = dict(hps.model)
+    model_kwargs["codebook_path"] = codebook_path
+    net_g = SynthesizerTrn(hps.data.filter_length // 2 + 1, hps.train.segment_size // hps.data.hop_length, **model_kwargs)
+    net_d = MultiPeriodDiscriminator(hps.model.use_spectral_norm)
+    if compile:
+        # as train.py: segment_size crops, static shapes
+        commons.compile_([net_g.dec] + list(net_d.discriminators), dynamic=False)
+    optim_g = torch.optim.AdamW(net_g.parameters(), hps.train.learning_rate, betas=hps.train.betas, eps=hps.train.eps)
+    optim_d = torch.optim.AdamW(net_d.parameters(), hps.train.learning_rate, betas=hps.train.betas, eps=hps.train.eps)
+    net_g.train()
+    net_d.train()
+
+    c, spec, y = batch
+    mel = spec_to_mel_torch(spec, hps.data.filter_length, hps.data.n_mel_channels, hps.data.sampling_rate,
+                            hps.data.mel_fmin, hps.data.mel_fmax)
+
+    timer = StageTimer("cpu")
+    for step in range(num_steps + 1):
+        # step 0 is warm-up (and compilation)
+        timer.reset()
+        with timer.stage("generator_forward"):
+            y_hat, ids_slice, _ = net_g(c)
+            y_mel = commons.slice_segments(mel, ids_slice, hps.train.segment_size // hps.data.hop_length)
+            y_hat_mel = mel_spectrogram_torch(y_hat.squeeze(1), hps.data.filter_length, hps.data.n_mel_channels,
+                                              hps.data.sampling_rate, hps.data.hop_length, hps.data.win_length,
+                                              hps.data.mel_fmin, hps.data.mel_fmax)
+            y_seg = commons.slice_segments(y, ids_slice * hps.data.hop_length, hps.train.segment_size)
+
+        with timer.stage("discriminator_step"):
+            y_d_hat_r, y_d_hat_g, _, _ = net_d(y_seg, y_hat.detach())
+            loss_disc, _, _ = discriminator_loss(y_d_hat_r, y_d_hat_g)
+            optim_d.zero_grad()
+            loss_disc.backward()
+            optim_d.step()
+
+        with timer.stage("generator_step"):
+            commons.set_requires_grad(net_d, False)
+            # grad_accum_steps 1: against the updated D
+            _, y_d_hat_g, fmap_r, fmap_g = net_d(y_seg, y_hat)
+            loss_mel = F.l1_loss(y_mel, y_hat_mel) * hps.train.c_mel
+            loss_gen, _ = generator_loss(y_d_hat_g)
+            loss_gen_all = loss_gen + feature_loss(fmap_r, fmap_g) + loss_mel
+            optim_g.zero_grad()
+            loss_gen_all.backward()
+            commons.set_requires_grad(net_d, True)
+            optim_g.step()
+
+        if step == 0:
+            totals = {name: 0. for name in timer.stages}
+        else:
+            for name, stats in timer.stages.items():
+                totals[name] += stats["seconds"]
+
+    step_seconds = sum(totals.values()) / num_steps
+    return {
+        "batch_size": c.size(0),
+        "compile": compile,
+        "threads": torch.get_num_threads(),
+        "seconds_per_step": step_seconds,
+        "samples_per_second": c.size(0) / step_seconds,
+        "stages_seconds": {name: seconds / num_steps for name, seconds in totals.items()},
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="./config/V9_VQ256_concat_5_40000.json", help="path to json config file")
+    parser.add_argument("--filelist", type=str, default=None, help="training filelist, hps.data.training_files if not given")
+    parser.add_argument("--synthetic", type=int, default=0, help="number of synthetic utterances to generate instead of --filelist")
+    parser.add_argument("--batch_size", type=int, default=None, help="hps.train.batch_size if not given")
+    parser.add_argument("--num_workers", type=int, nargs="+", default=[0, 2, 4], help="DataLoader workers to sweep")
+    parser.add_argument("--num_batches", type=int, default=50, help="batches per measurement")
+    parser.add_argument("--compute_ms", type=float, default=0., help="simulated training step time per batch")
+    parser.add_argument("--train_step", default=False, action="store_true", help="also time a synthetic CPU train step")
+    parser.add_argument("--train_steps", type=int, default=3, help="timed train steps")
+    parser.add_argument("--compile", default=False, action="store_true", help="also time the train step with torch.compile'd Generator and discriminators")
+    parser.add_argument("--codebook_path", type=str, default=None, help="codebook .pt, a random codebook if not given and hps.model.codebook_path is missing")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--out", type=str, default="./train_throughput.json", help="path to output json")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    hps = utils.get_hparams_from_file(args.config)
+    batch_size = args.batch_size or hps.train.batch_size
+
+    tmp_dir = tempfile.mkdtemp(prefix="train_throughput_")
+    try:
+        filelist = args.filelist or hps.data.training_files
+        if args.synthetic:
+            filelist = make_synthetic_dataset(tmp_dir, hps, args.synthetic)
+        dataset = TextAudioSpeakerLoader(filelist, hps)
+        collate_fn = TextAudioSpeakerCollate(hps)
+
+        def sampler():
+            return DistributedBucketSampler(dataset, batch_size, list(BOUNDARIES), num_replicas=1, rank=0, shuffle=True)
+
+        report = {"filelist": filelist, "utterances": len(dataset), "batch_size": batch_size,
+                  "batches_per_epoch": len(sampler()), "compute_ms": args.compute_ms}
+        report["stages"] = profile_stages(dataset, collate_fn, sampler(), args.num_batches)
+        print(json.dumps(report["stages"], indent=2))
+
+        report["loader"] = []
+        for num_workers in args.num_workers:
+            result = profile_loader(dataset, collate_fn, sampler(), num_workers, args.num_batches, args.compute_ms)
+            report["loader"].append(result)
+            print(json.dumps(result))
+
+        if args.train_step:
+            codebook_path = args.codebook_path or hps.model.codebook_path
+            if codebook_path is None or not os.path.exists(codebook_path):
+                codebook_path = os.path.join(tmp_dir, "codebook.pt")
+                torch.save(torch.randn(256, hps.model.hidden_channels), codebook_path)
+            batch = collate_fn([dataset[i] for i in next(iter(sampler()))])
+            report["train_step"] = profile_train_step(hps, batch, args.train_steps, codebook_path)
+            print(json.dumps(report["train_step"], indent=2))
+            if args.compile:
+                report["train_step_compiled"] = profile_train_step(hps, batch, args.train_steps, codebook_path, compile=True)
+                report["compile_speedup"] = report["train_step"]["seconds_per_step"] / report["train_step_compiled"]["seconds_per_step"]
+                print(json.dumps(report["train_step_compiled"], indent=2))
+                print("compile speedup: {:.2f}x".format(report["compile_speedup"]))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
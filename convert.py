@@ -2,7 +2,6 @@ import sys, os
 
 import argparse
 import torch
-import librosa
 import time
 from scipy.io.wavfile import write
 from tqdm import tqdm
@@ -13,28 +12,28 @@ import numpy as np
 
 import utils.utils as utils
 
-# from models.models_v9_wavlm12_40000 import SynthesizerTrn
-from models.models_v9_concat_5_40000 import SynthesizerTrn
-# from models.models_v8_VQ8192 import SynthesizerTrn
-# from models.models_v9_concat import SynthesizerTrn
-
-
-
-
-from utils.mel_processing import mel_spectrogram_torch, spectrogram_torch, spec_to_mel_torch
-from wavlm import WavLM, WavLMConfig
+from inference import VoiceConverter, load_pairs, pair_title
+from utils.profiling import StageTimer
 import shutil
 
-from evaluation.WER_EER_FakeScore import get_scores
-
-os.environ["CUDA_VISIBLE_DEVICES"]="1"
-
 
 import logging
 logging.getLogger('numba').setLevel(logging.WARNING)
 
 def get_path(*args):
         return os.path.join('', *args)
+
+
+def save_pair(converter, outdir, title, src_path, tgt_path, audio):
+    """<outdir>/<title>/: converted C!<title>.wav next to copies of the source and target"""
+    save_dir = os.path.join(outdir, f"{title}")
+    os.makedirs(save_dir, exist_ok=True)
+    
+    with converter.stage("write"):
+        write(os.path.join(save_dir, f"C!{title}.wav"), converter.sampling_rate, audio)
+    
+    shutil.copy2(src_path, f"{save_dir}/S!{src_path.split('/')[-1]}")
+    shutil.copy2(tgt_path, f"{save_dir}/T!{tgt_path.split('/')[-1]}")
     
 if __name__ == "__main__":
     
@@ -46,54 +45,48 @@ if __name__ == "__main__":
     parser.add_argument("--config", type=str, default=f"./config/V9_VQ256_concat_5_40000.json", help="path to json config file")
     parser.add_argument("--ptfile", type=str, default=f"./logs/{model_name}/G_{ckpt_num}000.pth", help="path to pth file")
     parser.add_argument("--src_path", type=str, default=f"/home/yjsim/VoiceConversion/ICASSP2025/conversion_metas/{meta_data}_pairs(1000).txt", help="path to txt file")
-    parser.add_argument("--tgt_path", type=str, default=f"/home/yjsim/VoiceConversion/ICASSP2025/conversion_metas/{meta_data}_pairs(1000).txt", help="path to txt file")
+    parser.add_argument("--tgt_path", type=str, nargs="+", default=[f"/home/yjsim/VoiceConversion/ICASSP2025/conversion_metas/{meta_data}_pairs(1000).txt"], help="path to target wav, several to convert the source to each (source encoded once)")
+    parser.add_argument("--max_batch", type=int, default=None, help="targets per generator batch with several --tgt_path, all if not given")
+    parser.add_argument("--pairs", type=str, default=None, help="pairs file (src|tgt or title|src|tgt per line) to convert instead of --src_path / --tgt_path")
+    parser.add_argument("--max_frames", type=int, default=4000, help="content frames (batch x longest source) per generator batch with --pairs")
     parser.add_argument("--outdir", type=str, default=f"./convert_result", help="path to output dir")
     
+    parser.add_argument("--device", type=str, default="cuda", help="device to run conversion on")
+    parser.add_argument("--quantize", default=False, action="store_true", help="dynamic int8 WavLM content encoder (CPU only)")
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16", "fp16"], help="autocast precision of WavLM and the generator")
     parser.add_argument("--use_timestamp", default=False, action="store_true")
+    parser.add_argument("--profile", default=False, action="store_true", help="print per-stage wall time, real-time factor and peak memory")
+    parser.add_argument("--compile", default=False, action="store_true", help="torch.compile the generator")
+    parser.add_argument("--attention", type=str, default="default", help="WavLM attention backend: default / sdpa / chunked (long inputs)")
+    parser.add_argument("--metrics_out", type=str, default=None, help="path to write per-stage metrics in Prometheus text format")
     args = parser.parse_args()
     
     os.makedirs(args.outdir, exist_ok=True)
-    hps = utils.get_hparams_from_file(args.hpfile)
-
-    print("Loading model...")
-    net_g = SynthesizerTrn(
-        hps.data.filter_length // 2 + 1,
-        hps.train.segment_size // hps.data.hop_length,
-        **hps.model).cuda()
-    _ = net_g.eval()
-    print("Loading checkpoint...")
-    _ = utils.load_checkpoint(args.ptfile, net_g, None, True)
+    hps = utils.get_hparams_from_file(args.config)
 
-    print("Loading WavLM for content...")
-    cmodel = utils.get_cmodel(0)
+    print("Loading model, checkpoint and WavLM for content...")
+    timer = StageTimer(args.device) if args.profile or args.metrics_out else None
+    converter = VoiceConverter(hps, args.ptfile, device=args.device, precision=args.precision, quantize=args.quantize, timer=timer, compile=args.compile, attention=args.attention)
     
-    print("Processing text...")
-
-    print(args.txtpath)
+    print(args.pairs or (args.src_path, args.tgt_path))
     print(args.outdir)
     print("Synthesizing...")
-    with torch.no_grad():
-
-        # src
-        wav_src, _ = librosa.load(hps.src_path, sr=hps.data.sampling_rate)
-        wav_src = torch.from_numpy(wav_src).unsqueeze(0).cuda()
-        src_c = utils.get_content(cmodel, wav_src, layer=6)
-        
-        wav_tgt, _ = librosa.load(hps.tgt_path, sr=hps.data.sampling_rate)
-        wav_tgt, _ = librosa.effects.trim(wav_tgt, top_db=20)
-        wav_tgt = torch.from_numpy(wav_tgt).unsqueeze(0).cuda()
-        tgt_c = utils.get_content(cmodel, wav_tgt, layer=6)
-        
-
-        audio = net_g.convert(src_c, tgt_c)
-        audio = audio[0][0].data.cpu().float().numpy()
-        
+    if args.pairs is not None:
+        # every unique source / target encoded once, see VoiceConverter.convert_pairs
+        pairs = load_pairs(args.pairs)
+        for i, audio in tqdm(converter.convert_pairs([(src, tgt) for _, src, tgt in pairs], max_frames=args.max_frames), total=len(pairs)):
+            save_pair(converter, args.outdir, *pairs[i], audio)
+    else:
+        wav_src = converter.load_wav(args.src_path)
+        # one WavLM / VQ pass of the source for every target, see convert_fanout
+        g_tgt = torch.cat([converter.speaker_embedding(converter.load_wav(tgt_path, trim=True)) for tgt_path in args.tgt_path])
+        audios = converter.convert_fanout(wav_src, g_tgt, max_batch=args.max_batch)
             
-        title = 'src;' + hps.src_path.split('/')[-1][:-4] + '&tgt;' + hps.tgt_path.split('/')[-1][:-4]
-        save_dir = os.path.join(args.outdir, f"{title}")
-        os.makedirs(save_dir, exist_ok=True)
-        
-        write(os.path.join(save_dir, f"C!{title}.wav"), hps.data.sampling_rate, audio)
-        
-        shutil.copy2(src, f"{save_dir}/S!{hps.src_path.split('/')[-1]}")
-        shutil.copy2(tgt, f"{save_dir}/T!{hps.tgt_path.split('/')[-1]}")
+        for tgt_path, audio in zip(args.tgt_path, audios):
+            save_pair(converter, args.outdir, pair_title(args.src_path, tgt_path), args.src_path, tgt_path, audio)
+
+    if timer is not None:
+        print(json.dumps(timer.summary(), indent=2))
+        if args.metrics_out:
+            with open(args.metrics_out, "w") as f:
+                f.write(timer.prometheus())
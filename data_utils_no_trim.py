@@ -7,10 +7,10 @@ import os
 
 import time
 import random
+import contextlib
 import numpy as np
 import torch
 import torch.utils.data
-import librosa
 from utils import commons
 from utils.mel_processing import spectrogram_torch, spec_to_mel_torch, mel_spectrogram_torch
 from utils.utils import load_wav_to_torch, load_filepaths_and_text, transform
@@ -40,9 +40,14 @@ class TextAudioSpeakerLoader(torch.utils.data.Dataset):
         self.use_sr = hparams.train.use_sr
         self.use_spk = hparams.model.use_spk
         self.spec_len = hparams.train.max_speclen
+        # content features of vctk-16k/x.wav are read from <content_dir>/x.pt
+        # (one directory per WavLM layer, see preprocess_ssl.py --layers)
+        self.content_dir = hparams.data.get("content_dir", "wavlm-6L")
         random.seed(1234)
         random.shuffle(self.audiopaths)
         self._filter()
+        # optional utils.profiling.StageTimer (benchmarks/train_throughput.py)
+        self.timer = None
 
     def _filter(self):
         """
@@ -54,9 +59,12 @@ class TextAudioSpeakerLoader(torch.utils.data.Dataset):
             lengths.append(os.path.getsize(audiopath[0]) // (2 * self.hop_length))
         self.lengths = lengths
 
+    def stage(self, name):
+        return self.timer.stage(name) if self.timer is not None else contextlib.nullcontext()
     
     def get_audio(self, filename):
-        audio, sampling_rate = load_wav_to_torch(filename)
+        with self.stage("wav_read"):
+            audio, sampling_rate = load_wav_to_torch(filename)
         if sampling_rate != self.sampling_rate:
             raise ValueError("{} SR doesn't match target {} SR".format(
                 sampling_rate, self.sampling_rate))
@@ -65,18 +73,20 @@ class TextAudioSpeakerLoader(torch.utils.data.Dataset):
         audio_norm = audio_norm.unsqueeze(0)
         spec_filename = filename.replace(".wav", ".spec_no_trim.pt")
         
-        if os.path.exists(spec_filename):
-            spec = torch.load(spec_filename)
-        else:
-            spec = spectrogram_torch(audio_norm, self.filter_length,
-                self.sampling_rate, self.hop_length, self.win_length,
-                center=False)
-            spec = torch.squeeze(spec, 0)
-            torch.save(spec, spec_filename)
+        with self.stage("spec_load"):
+            if os.path.exists(spec_filename):
+                spec = torch.load(spec_filename)
+            else:
+                spec = spectrogram_torch(audio_norm, self.filter_length,
+                    self.sampling_rate, self.hop_length, self.win_length,
+                    center=False)
+                spec = torch.squeeze(spec, 0)
+                torch.save(spec, spec_filename)
 
         c_filename = filename.replace(".wav", ".pt")
-        c_filename = c_filename.replace("vctk-16k", "wavlm-6L")
-        c = torch.load(c_filename).squeeze(0)
+        c_filename = c_filename.replace("vctk-16k", self.content_dir)
+        with self.stage("content_load"):
+            c = torch.load(c_filename).squeeze(0)
 
         return c, spec, audio_norm
         
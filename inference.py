@@ -0,0 +1,302 @@
+import os
+import argparse
+import contextlib
+from glob import glob
+
+import torch
+import numpy as np
+from torch.nn import functional as F
+
+import utils.utils as utils
+from utils import audio, commons
+from utils.mel_processing import mel_spectrogram_torch
+from utils.profiling import StageTimer
+from models.models_v9_concat_5_40000 import SynthesizerTrn
+
+
+PRECISIONS = {
+    "fp32": None,
+    "bf16": torch.bfloat16,
+    "fp16": torch.float16,
+}
+
+
+def autocast(device, precision):
+    """Autocast context for WavLM and the Generator (no-op for fp32).
+
+    VQ distances and speaker means are kept in fp32 by the models themselves.
+    """
+    dtype = PRECISIONS[precision]
+    return torch.autocast(device_type=torch.device(device).type, dtype=dtype or torch.float32, enabled=dtype is not None)
+
+
+def pair_title(src_path, tgt_path):
+    """Output name of a conversion: src;<source name>&tgt;<target name>"""
+    name = lambda path: os.path.splitext(os.path.basename(path))[0]
+    return "src;{}&tgt;{}".format(name(src_path), name(tgt_path))
+
+
+def load_pairs(path):
+    """
+    Conversion pairs file -> list of (title, src_path, tgt_path).
+    One pair per line: src|tgt, or title|src|tgt as in FreeVC's convert.txt.
+    """
+    pairs = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            fields = line.strip().split("|")
+            if fields == [""]:
+                continue
+            assert len(fields) in (2, 3), "expected src|tgt or title|src|tgt, got {}".format(line.strip())
+            if len(fields) == 2:
+                fields = [pair_title(*fields)] + fields
+            pairs.append(tuple(fields))
+    return pairs
+
+
+class VoiceConverter():
+    """
+    Conversion engine
+      - loads the WavLM content model and the generator once
+      - converts (source wav, target wav) pairs
+
+    precision: fp32 / bf16 (CPU or GPU) / fp16 (GPU)
+    quantize: dynamic int8 content model, CPU and fp32 only
+    ptfile: generator checkpoint, None keeps random weights (benchmarks)
+    timer: optional utils.profiling.StageTimer, records the decode / content / quantize / generator stages
+    compile: torch.compile the generator (dynamic shapes, compiled on the first conversion)
+    attention: WavLM attention backend, default / sdpa / chunked (memory linear in the input length)
+    """
+    def __init__(self, hps, ptfile, device="cuda", precision="fp32", quantize=False, layer=6, cmodel_path=None, timer=None, compile=False, attention="default"):
+        assert precision in PRECISIONS, "unknown precision {}".format(precision)
+        self.hps = hps
+        self.device = torch.device(device)
+        self.precision = precision
+        self.layer = layer
+        self.sampling_rate = hps.data.sampling_rate
+        if precision == "fp16":
+            assert self.device.type == "cuda", "fp16 autocast needs a GPU, use bf16 on CPU"
+        if quantize:
+            assert self.device.type == "cpu" and precision == "fp32", "int8 content model runs on CPU in fp32"
+
+        self.net_g = SynthesizerTrn(
+            hps.data.filter_length // 2 + 1,
+            hps.train.segment_size // hps.data.hop_length,
+            **hps.model).to(self.device)
+        self.net_g.eval()
+        if ptfile is not None:
+            utils.load_checkpoint(ptfile, self.net_g, None, True)
+        else:
+            print("No generator checkpoint, using random weights (benchmarking only)")
+        if compile:
+            commons.compile_([self.net_g.dec])
+
+        cmodel_kwargs = {} if cmodel_path is None else {"checkpoint_path": cmodel_path}
+        self.cmodel = utils.get_cmodel(self.device, quantize=quantize, attention=attention, **cmodel_kwargs)
+
+        self.timer = timer
+        if timer is not None:
+            timer.attach(self.net_g.codebook, "quantize")
+            timer.attach(self.net_g.dec, "generator")
+
+    def stage(self, name):
+        return self.timer.stage(name) if self.timer is not None else contextlib.nullcontext()
+
+    def add_audio(self, wav):
+        """Counts converted source audio (B, T) for the timer's real-time factor and frames/s"""
+        if self.timer is not None:
+            self.timer.add_audio(wav.numel() / self.sampling_rate, int(self.content_lengths([wav.size(-1)]).item()) * wav.size(0))
+
+    def load_wav(self, path, trim=False):
+        with self.stage("decode"):
+            wav, _ = audio.load(path, sr=self.sampling_rate)
+            if trim:
+                import librosa
+                wav, _ = librosa.effects.trim(wav, top_db=20)
+        return torch.from_numpy(wav).unsqueeze(0)
+
+    @torch.no_grad()
+    def get_content(self, wav):
+        with self.stage("content"), autocast(self.device, self.precision):
+            return utils.get_content(self.cmodel, wav.to(self.device), layer=self.layer)
+
+    @torch.no_grad()
+    def convert(self, wav_src, wav_tgt):
+        """wav_src, wav_tgt: (1, T) float tensors -> converted audio (T',) float32 numpy"""
+        src_c = self.get_content(wav_src)
+        tgt_c = self.get_content(wav_tgt)
+        with autocast(self.device, self.precision):
+            audio = self.net_g.convert(src_c, tgt_c)
+        self.add_audio(wav_src)
+        return audio[0][0].data.cpu().float().numpy()
+
+    @torch.no_grad()
+    def convert_fanout(self, wav_src, g_tgt, max_batch=None):
+        """
+        Converts one source to K targets: WavLM content and VQ of the source run once,
+        the generator in batches of max_batch targets (all K if None).
+
+        wav_src: (1, T) float tensor
+        g_tgt: (K, D, 1) target speaker vectors, see speaker_embedding
+        returns: (K, T') float32 numpy, one converted audio per target
+        """
+        src_c = self.get_content(wav_src)
+        with autocast(self.device, self.precision):
+            audio = self.net_g.convert_fanout(src_c, g_tgt.to(self.device), max_batch=max_batch)
+        self.add_audio(wav_src.expand(g_tgt.size(0), -1))
+        return audio[:, 0].data.cpu().float().numpy()
+
+    @torch.no_grad()
+    def speaker_embedding(self, wav_tgt):
+        """(1, T) target wav -> (1, D, 1) speaker vector, cacheable per target"""
+        tgt_c = self.get_content(wav_tgt)
+        return self.net_g.speaker_embedding(tgt_c)
+
+    def content_lengths(self, wav_lengths):
+        """Number of WavLM frames for each wav length (conv feature extractor arithmetic)"""
+        lengths = torch.as_tensor(wav_lengths, dtype=torch.long)
+        for _, kernel_size, stride in eval(self.cmodel.cfg.conv_feature_layers):
+            lengths = torch.div(lengths - kernel_size, stride, rounding_mode="floor") + 1
+        return lengths
+
+    @torch.no_grad()
+    def convert_batch(self, wavs_src, g_tgt):
+        """
+        Converts a padded batch of sources in one content model and generator pass.
+
+        wavs_src: list of (1, T_i) float tensors
+        g_tgt: (B, D, 1) target speaker vectors, see speaker_embedding
+        returns: list of converted audio (T_i',) float32 numpy, trimmed per item
+        """
+        wav_lengths = [wav.size(-1) for wav in wavs_src]
+        wav = torch.zeros(len(wavs_src), max(wav_lengths))
+        padding_mask = torch.ones(len(wavs_src), max(wav_lengths), dtype=torch.bool)
+        for i, w in enumerate(wavs_src):
+            wav[i, :w.size(-1)] = w[0]
+            padding_mask[i, :w.size(-1)] = False
+
+        c_lengths = self.content_lengths(wav_lengths).to(self.device)
+        with autocast(self.device, self.precision):
+            with self.stage("content"):
+                src_c = utils.get_content(self.cmodel, wav.to(self.device), layer=self.layer, padding_mask=padding_mask.to(self.device))
+            audio = self.net_g.convert(src_c, c_lengths=c_lengths, g_tgt=g_tgt.to(self.device))
+        if self.timer is not None:
+            self.timer.add_audio(sum(wav_lengths) / self.sampling_rate, int(c_lengths.sum()))
+
+        hop_length = int(np.prod(self.hps.model.upsample_rates))
+        audio = audio[:, 0].data.cpu().float().numpy()
+        return [audio[i, :int(c_lengths[i]) * hop_length] for i in range(len(wavs_src))]
+
+    @torch.no_grad()
+    def convert_pairs(self, pairs, max_frames=4000):
+        """
+        Converts every (src_path, tgt_path) pair of an N x M list (e.g. every test source to
+        every test target).
+
+        Each unique source and target goes through WavLM and the VQ once, N + M encoder
+        passes instead of two per pair; the source z / residual and the target speaker vectors
+        are kept on the CPU. The generator then decodes the pairs, longest source first, in
+        padded masked batches of at most max_frames content frames (batch size x longest
+        source), which bounds its activation memory. A longer source is decoded alone.
+
+        yields: (index into pairs, converted audio (T',) float32 numpy), in decoding order
+        """
+        sources, targets = {}, {}
+        for src_path in dict.fromkeys(src_path for src_path, _ in pairs):
+            wav_src = self.load_wav(src_path)
+            src_c = self.get_content(wav_src)
+            with autocast(self.device, self.precision):
+                z, _, residual = self.net_g.split(src_c)
+            sources[src_path] = (z[0].cpu(), residual[0].cpu(), wav_src.size(-1))
+        for tgt_path in dict.fromkeys(tgt_path for _, tgt_path in pairs):
+            targets[tgt_path] = self.speaker_embedding(self.load_wav(tgt_path, trim=True))[0].cpu()
+
+        order = sorted(range(len(pairs)), key=lambda i: -sources[pairs[i][0]][0].size(-1))
+        batch = []
+        for i in order:
+            # longest first: the first pair of a batch sets its padded length
+            if batch and (len(batch) + 1) * sources[pairs[batch[0]][0]][0].size(-1) > max_frames:
+                yield from self._decode_pairs(pairs, batch, sources, targets)
+                batch = []
+            batch.append(i)
+        if batch:
+            yield from self._decode_pairs(pairs, batch, sources, targets)
+
+    def _decode_pairs(self, pairs, indices, sources, targets):
+        """Generator pass of pairs[indices] from the cached source / target encodings"""
+        items = [sources[pairs[i][0]] for i in indices]
+        c_lengths = torch.tensor([z.size(-1) for z, _, _ in items])
+        z = torch.zeros(len(items), items[0][0].size(0), int(c_lengths.max()), dtype=items[0][0].dtype)
+        residual = torch.zeros(len(items), items[0][1].size(0), z.size(-1))
+        for i, (z_i, residual_i, _) in enumerate(items):
+            z[i, :, :z_i.size(-1)] = z_i
+            residual[i, :, :residual_i.size(-1)] = residual_i
+        g_tgt = torch.stack([targets[pairs[i][1]] for i in indices]).to(self.device)
+
+        z, residual, c_lengths = z.to(self.device), residual.to(self.device), c_lengths.to(self.device)
+        with autocast(self.device, self.precision):
+            audio = self.net_g.dec(z, g=g_tgt, res=residual, x_mask=self.net_g.content_mask(z, c_lengths))
+        if self.timer is not None:
+            self.timer.add_audio(sum(wav_length for _, _, wav_length in items) / self.sampling_rate, int(c_lengths.sum()))
+
+        hop_length = int(np.prod(self.hps.model.upsample_rates))
+        audio = audio[:, 0].data.cpu().float().numpy()
+        for i, index in enumerate(indices):
+            yield index, audio[i, :int(c_lengths[i]) * hop_length]
+
+    def mel(self, audio):
+        hps = self.hps
+        return mel_spectrogram_torch(
+            torch.from_numpy(audio).unsqueeze(0),
+            hps.data.filter_length,
+            hps.data.n_mel_channels,
+            hps.data.sampling_rate,
+            hps.data.hop_length,
+            hps.data.win_length,
+            hps.data.mel_fmin,
+            hps.data.mel_fmax)
+
+
+def precision_parity(converter, pairs, precisions=("bf16",)):
+    """Mel L1 between fp32 conversions and conversions at each precision.
+
+    pairs: list of (src_path, tgt_path)
+    """
+    report = {}
+    for precision in precisions:
+        losses = []
+        for src_path, tgt_path in pairs:
+            wav_src = converter.load_wav(src_path)
+            wav_tgt = converter.load_wav(tgt_path, trim=True)
+
+            converter.precision = "fp32"
+            mel_ref = converter.mel(converter.convert(wav_src, wav_tgt))
+            converter.precision = precision
+            mel_test = converter.mel(converter.convert(wav_src, wav_tgt))
+            losses.append(F.l1_loss(mel_test, mel_ref).item())
+        report[precision] = {"mel_l1_mean": float(np.mean(losses)), "mel_l1_max": float(np.max(losses))}
+    converter.precision = "fp32"
+    return report
+
+
+if __name__ == "__main__":
+    # objective parity check of reduced precision conversion against fp32
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="./config/V9_VQ256_concat_5_40000.json", help="path to json config file")
+    parser.add_argument("--ptfile", type=str, required=True, help="path to pth file")
+    parser.add_argument("--wav_dir", type=str, default="./data_sample/VCTK", help="path to wav dir (speaker/*.wav)")
+    parser.add_argument("--num_pairs", type=int, default=10, help="number of conversion pairs")
+    parser.add_argument("--device", type=str, default="cuda", help="device to run conversion on")
+    parser.add_argument("--precisions", type=str, nargs="+", default=["bf16"], help="precisions to compare against fp32")
+    args = parser.parse_args()
+
+    hps = utils.get_hparams_from_file(args.config)
+    converter = VoiceConverter(hps, args.ptfile, device=args.device)
+
+    speakers = sorted(os.listdir(args.wav_dir))
+    wavs = [sorted(glob(os.path.join(args.wav_dir, speaker, "*.wav"))) for speaker in speakers]
+    # source and target from different speakers, round robin
+    pairs = [(wavs[i % len(wavs)][i // len(wavs)], wavs[(i + 1) % len(wavs)][i // len(wavs)]) for i in range(args.num_pairs)]
+
+    for precision, result in precision_parity(converter, pairs, args.precisions).items():
+        print(precision, result)
@@ -119,7 +119,12 @@ class Generator(torch.nn.Module):
             self.cond = nn.Conv1d(gin_channels, upsample_initial_channel, 1)
             self.cond_res = nn.Conv1d(gin_channels, 8, 1)
             
-    def forward(self, x, g=None, res=None):
+    def forward(self, x, g=None, res=None, x_mask=None):
+        # x_mask (B, 1, T) of a padded batch: frames past each item's length
+        # are zeroed before every conv, as the zero padding of a batch of one,
+        # so each item decodes as it would alone (silence past its length)
+        if x_mask is not None:
+            x, res = x * x_mask, res * x_mask
         x = self.conv_pre_1(x)
         res = self.cond_res(res)
 
@@ -131,17 +136,23 @@ class Generator(torch.nn.Module):
         
         for i in range(self.num_upsamples):
             x = F.leaky_relu(x, modules_v9.LRELU_SLOPE)
+            if x_mask is not None:
+                x = x * x_mask
             x = self.ups[i](x)
+            if x_mask is not None:
+                x_mask = x_mask.repeat_interleave(self.ups[i].stride[0], dim=-1)
             xs = None
             for j in range(self.num_kernels):
                 if xs is None:
-                    xs = self.resblocks[i*self.num_kernels+j](x)
+                    xs = self.resblocks[i*self.num_kernels+j](x, x_mask)
                 else:
-                    xs += self.resblocks[i*self.num_kernels+j](x)
+                    xs += self.resblocks[i*self.num_kernels+j](x, x_mask)
             x = xs / self.num_kernels
         x = F.leaky_relu(x)
         x = self.conv_post(x)
         x = torch.tanh(x)
+        if x_mask is not None:
+            x = x * x_mask
 
         return x
 
@@ -228,19 +239,34 @@ class MultiPeriodDiscriminator(torch.nn.Module):
         self.discriminators = nn.ModuleList(discs)
 
     def forward(self, y, y_hat):
-        y_d_rs = []
-        y_d_gs = []
-        fmap_rs = []
-        fmap_gs = []
-        for i, d in enumerate(self.discriminators):
-            y_d_r, fmap_r = d(y)
-            y_d_g, fmap_g = d(y_hat)
-            y_d_rs.append(y_d_r)
-            y_d_gs.append(y_d_g)
-            fmap_rs.append(fmap_r)
-            fmap_gs.append(fmap_g)
+        if y.shape != y_hat.shape:
+            y_d_rs, fmap_rs = self.forward_single(y)
+            y_d_gs, fmap_gs = self.forward_single(y_hat)
+            return y_d_rs, y_d_gs, fmap_rs, fmap_gs
+
+        # real and generated audio in one batch per sub-discriminator
+        b = y.size(0)
+        y_d, fmap = self.forward_single(torch.cat([y, y_hat], dim=0))
+        y_d_rs = [x[:b] for x in y_d]
+        y_d_gs = [x[b:] for x in y_d]
+        fmap_rs = [[x[:b] for x in f] for f in fmap]
+        fmap_gs = [[x[b:] for x in f] for f in fmap]
 
         return y_d_rs, y_d_gs, fmap_rs, fmap_gs
+
+    def forward_single(self, x):
+        """
+        Outputs and feature maps for one input, e.g. only the generated audio in the
+        generator step while the real-audio features of the discriminator step are reused
+        """
+        y_ds = []
+        fmaps = []
+        for d in self.discriminators:
+            y_d, fmap = d(x)
+            y_ds.append(y_d)
+            fmaps.append(fmap)
+
+        return y_ds, fmaps
         
 
 class SynthesizerTrn(nn.Module):
@@ -322,40 +348,73 @@ class SynthesizerTrn(nn.Module):
     return o, ids_slice, (commitment_loss, perplexity)
 
   def infer(self, c, c_lengths=None):
-    if c_lengths == None:
-      c_lengths = (torch.ones(c.size(0)) * c.size(-1)).to(c.device)
+    """
+    c_lengths: valid frames of each item of a padded batch, see split.
+    The output is silent past c_lengths * hop samples.
+    """
+    fig = None
+    z, spk_emb_avg, residual_emb = self.split(c, c_lengths)
+    o = self.dec(z, g=spk_emb_avg, res=residual_emb, x_mask=self.content_mask(c, c_lengths))
+    
+    return o, fig
 
+  def content_mask(self, c, c_lengths=None):
+    """(B, 1, T) mask of the valid frames of a padded batch c, None without c_lengths"""
+    if c_lengths is None:
+        return None
+    return torch.unsqueeze(commons.sequence_mask(c_lengths, c.size(-1)), 1).float()
+
+  def split(self, c, c_lengths=None):
+    """
+    Splits content c (B, D, T) into VQ content z, utterance speaker vector (B, D, 1) and
+    the remaining frame-level residual, the latter two in fp32 under mixed precision
+
+    c_lengths: valid frames of each item of a padded batch. The speaker vector is
+    then the mean over those frames only and the residual is zero past them, so
+    each item gets the values it would get alone.
+    """
     quantized, commitment_loss, perplexity = self.codebook(c)
-    fig = None
     if quantized.size(1) != c.size(1):
         quantized = quantized.permute(0, 2, 1)
-        
-    # speaker emb
-    speaker_emb = c - quantized
-    spk_emb_avg = torch.mean(speaker_emb, dim=-1, keepdim=True)
-    residual_emb = speaker_emb - spk_emb_avg
-    z = quantized
-    o = self.dec(z, g=spk_emb_avg, res=residual_emb)
-    
-    return o, fig
 
-  def convert(self, src_c, tgt_c, c_lengths=None):
-    quantized_src, commitment_loss, perplexity = self.codebook(src_c)
-    quantized_tgt, commitment_loss, perplexity = self.codebook(tgt_c)
-    if quantized_src.size(1) != src_c.size(1):
-        quantized_src = quantized_src.permute(0, 2, 1)
-        quantized_tgt = quantized_tgt.permute(0, 2, 1)
-        
-    speaker_emb_tgt = tgt_c - quantized_tgt
-    speaker_emb_src = src_c - quantized_src
-    speaker_emb_avg_tgt = torch.mean(speaker_emb_tgt, dim=-1, keepdim=True)
-    speaker_emb_avg_src = torch.mean(speaker_emb_src, dim=-1, keepdim=True)
-    
-    residual_emb_src = speaker_emb_src - speaker_emb_avg_src
-    z_src = quantized_src
-    o = self.dec(z_src, g=speaker_emb_avg_tgt, res=residual_emb_src)
+    speaker_emb = c.float() - quantized
+    if c_lengths is None:
+        speaker_emb_avg = torch.mean(speaker_emb, dim=-1, keepdim=True)
+        residual_emb = speaker_emb - speaker_emb_avg
+    else:
+        mask = self.content_mask(c, c_lengths)
+        speaker_emb_avg = torch.sum(speaker_emb * mask, dim=-1, keepdim=True) / c_lengths.view(-1, 1, 1)
+        residual_emb = (speaker_emb - speaker_emb_avg) * mask
+    return quantized, speaker_emb_avg, residual_emb
+
+  def speaker_embedding(self, c, c_lengths=None):
+    """
+    Utterance-level speaker vector (B, D, 1): time average of the quantization residual c - VQ(c)
+    """
+    return self.split(c, c_lengths)[1]
+
+  def convert(self, src_c, tgt_c=None, c_lengths=None, g_tgt=None, tgt_lengths=None):
+    """
+    c_lengths / tgt_lengths: valid frames of each item of padded src_c / tgt_c batches
+    g_tgt: precomputed target speaker vector (B, D, 1) used instead of tgt_c, see speaker_embedding
+    """
+    z_src, speaker_emb_avg_src, residual_emb_src = self.split(src_c, c_lengths)
+    if g_tgt is None:
+        g_tgt = self.speaker_embedding(tgt_c, tgt_lengths)
+    o = self.dec(z_src, g=g_tgt, res=residual_emb_src, x_mask=self.content_mask(src_c, c_lengths))
     
     return o
 
-
-
+  def convert_fanout(self, src_c, g_tgt, max_batch=None):
+    """
+    Converts one source src_c (1, D, T) to K target speaker vectors g_tgt (K, D, 1): the
+    source is quantized once and its z / residual are shared by a generator batch of up
+    to max_batch targets (all K if None). Returns (K, 1, T') like convert.
+    """
+    z_src, speaker_emb_avg_src, residual_emb_src = self.split(src_c)
+    max_batch = max_batch or g_tgt.size(0)
+    o = []
+    for g in torch.split(g_tgt, max_batch):
+        k = g.size(0)
+        o.append(self.dec(z_src.expand(k, -1, -1), g=g, res=residual_emb_src.expand(k, -1, -1)))
+    return torch.cat(o)
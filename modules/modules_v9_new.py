@@ -441,7 +441,10 @@ class VQEmbeddingEMA(nn.Module):
     #   print(x.size(0) )
     
     # cosine similarity metric
-    quantized, encodings = self.L2_distance(x, codebook)
+    # distances and code lookup stay in fp32 under mixed precision
+    with torch.autocast(device_type=x.device.type, enabled=False):
+      x = x.float()
+      quantized, encodings = self.L2_distance(x, codebook.float())
     # quantized, encodings = self.cosine_sim(x,codebook)
 
     commitment_loss = F.mse_loss(x.detach(), quantized)
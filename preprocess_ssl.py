@@ -5,28 +5,37 @@ import sys
 import os
 import argparse
 import torch
-import librosa
 from glob import glob
 from tqdm import tqdm
 
-# import utils.utils as utils
-import utils
+import utils.utils as utils
+from utils import audio
 
-from wavlm import WavLM, WavLMConfig
-os.environ["CUDA_VISIBLE_DEVICES"]="0"
 
+def out_dir(layer):
+    return args.out_dir.format(layer=layer)
 
-def process(filename):
+
+def save_names(filename):
+    """{layer: feature path} of one wav, one directory per layer"""
     basename = os.path.basename(filename)
     speaker = basename[:4]
-    save_dir = os.path.join(args.out_dir, speaker)
-    os.makedirs(save_dir, exist_ok=True)
-    wav, _ = librosa.load(filename, sr=args.sr)
-    wav = torch.from_numpy(wav).unsqueeze(0).cuda()
-    # c = utils.get_content(cmodel, wav)
-    c = utils.get_content(cmodel, wav, layer=6)
-    save_name = os.path.join(save_dir, basename.replace(".wav", ".pt"))
-    torch.save(c.cpu(), save_name)
+    return {layer: os.path.join(out_dir(layer), speaker, basename.replace(".wav", ".pt")) for layer in args.layers}
+
+
+def done(filename):
+    return all(os.path.exists(name) for name in save_names(filename).values())
+
+
+def process(filename, wav):
+    names = save_names(filename)
+    wav = torch.from_numpy(wav).unsqueeze(0).to(device)
+    # every layer from one WavLM pass: the conv front end and the lower
+    # layers run once
+    cs = utils.get_content(cmodel, wav, layer=args.layers)
+    for layer, c in zip(args.layers, cs):
+        os.makedirs(os.path.dirname(names[layer]), exist_ok=True)
+        torch.save(c.cpu(), names[layer])
 
 
 if __name__ == "__main__":
@@ -35,21 +44,28 @@ if __name__ == "__main__":
     # parser.add_argument("--in_dir", type=str, default="/shared/racoon_fast/sim/VCTK/preprocessed/vctk-16k_no_trim", help="path to input dir")
     # parser.add_argument("--out_dir", type=str, default="/shared/racoon_fast/sim/VCTK/preprocessed/wavlm-6L_no_trim", help="path to output dir")
     parser.add_argument("--in_dir", type=str, default="/shared/NAS_HDD/VC/Dataset/LibriTTS/preprocessed/LibriTTS-360-16k_train_no_trim", help="path to input dir")
-    parser.add_argument("--out_dir", type=str, default="/shared/NAS_HDD/VC/Dataset/LibriTTS/preprocessed/wavlm-360-6L_train_no_trim", help="path to output dir")
+    parser.add_argument("--out_dir", type=str, default="/shared/NAS_HDD/VC/Dataset/LibriTTS/preprocessed/wavlm-360-{layer}L_train_no_trim", help="path to output dir, {layer} is replaced by the layer")
+    parser.add_argument("--layers", type=int, nargs="+", default=[6], help="WavLM layers to extract, in one pass")
+    parser.add_argument("--wavlm_path", type=str, default="/home/yjsim/VoiceConversion/ICASSP2025/wavlm/WavLM-Large.pt", help="path to WavLM checkpoint")
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu", help="device to run WavLM on: cpu, cuda or cuda:<index>")
+    parser.add_argument("--attention", type=str, default="default", help="WavLM attention backend: default / sdpa / chunked (long inputs)")
+    parser.add_argument("--skip_existing", default=False, action="store_true", help="skip wavs whose features exist for every layer")
+    parser.add_argument("--num_workers", type=int, default=4, help="threads decoding wavs ahead of WavLM")
     args = parser.parse_args()
-    
-    os.makedirs(args.out_dir, exist_ok=True)
+    assert len(set(out_dir(layer) for layer in args.layers)) == len(args.layers), "--out_dir needs {layer} to extract several layers"
+
+    for layer in args.layers:
+        os.makedirs(out_dir(layer), exist_ok=True)
 
     print("Loading WavLM for content...")
-    checkpoint = torch.load('/home/yjsim/VoiceConversion/ICASSP2025/wavlm/WavLM-Large.pt')
-    cfg = WavLMConfig(checkpoint['cfg'])
-    cmodel = WavLM(cfg).cuda()
-    cmodel.load_state_dict(checkpoint['model'])
-    cmodel.eval()
+    device = torch.device(args.device)
+    cmodel = utils.get_cmodel(device, checkpoint_path=args.wavlm_path, attention=args.attention)
     print("Loaded WavLM.")
     
     filenames = glob(f'{args.in_dir}/*/*.wav', recursive=True)
+    if args.skip_existing:
+        filenames = [filename for filename in filenames if not done(filename)]
     
-    for filename in tqdm(filenames):
-        process(filename)
+    for filename, wav in tqdm(audio.load_many(filenames, sr=args.sr, num_workers=args.num_workers), total=len(filenames)):
+        process(filename, wav)
     
\ No newline at end of file
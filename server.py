@@ -0,0 +1,325 @@
+"""
+Conversion server
+
+  - loads WavLM and the generator once (inference.VoiceConverter)
+  - micro-batches concurrent requests arriving within --max_wait_ms into one
+    padded content model + generator pass
+  - rejects requests with 503 when --max_queue requests are already waiting
+
+Endpoints
+  POST /convert?target_id=<id>   body: source wav                       -> converted wav
+  POST /convert                  body: {"source": b64 wav, "target": b64 wav | "target_id": id}
+  GET  /targets                  known target ids
+  GET  /health
+  GET  /metrics                  Prometheus text format (+ per-stage timings with --profile)
+
+  curl --data-binary @source.wav "localhost:8000/convert?target_id=p225_001" -o converted.wav
+"""
+import io
+import os
+import json
+import time
+import base64
+import asyncio
+import argparse
+from glob import glob
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from scipy.io.wavfile import write
+
+import utils.utils as utils
+from utils import audio
+from inference import VoiceConverter
+from utils.profiling import StageTimer
+
+
+STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+          413: "Payload Too Large", 431: "Request Header Fields Too Large", 500: "Internal Server Error",
+          503: "Service Unavailable"}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def decode_wav(data, sampling_rate):
+    """wav (or flac / ogg) bytes -> (1, T) float32 tensor at sampling_rate"""
+    try:
+        wav, _ = audio.decode(data, sr=sampling_rate)
+    except (RuntimeError, ValueError, TypeError) as e:
+        # soundfile raises LibsndfileError (a RuntimeError) on unreadable audio
+        raise HTTPError(400, "invalid audio: {}".format(e))
+    return torch.from_numpy(wav).unsqueeze(0)
+
+
+def encode_wav(audio, sampling_rate):
+    buf = io.BytesIO()
+    write(buf, sampling_rate, audio)
+    return buf.getvalue()
+
+
+class Metrics():
+    def __init__(self):
+        self.counters = {
+            "requests_total": 0,
+            "rejected_total": 0,
+            "errors_total": 0,
+            "batches_total": 0,
+            "batch_items_total": 0,
+            "batch_retries_total": 0,
+            "request_seconds_sum": 0.,
+            "request_seconds_count": 0,
+            "audio_seconds_total": 0.,
+        }
+
+    def inc(self, name, value=1):
+        self.counters[name] += value
+
+    def prometheus(self, gauges):
+        lines = []
+        for name, value in list(self.counters.items()) + list(gauges.items()):
+            lines.append("linearvc_{} {}".format(name, value))
+        return "\n".join(lines) + "\n"
+
+
+class ConversionServer():
+    def __init__(self, converter, targets, max_batch=8, max_wait_ms=20, max_queue=64, max_body_mb=32, decode_workers=2):
+        self.converter = converter
+        self.target_paths = targets
+        self.target_cache = {}
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.max_body = max_body_mb * 1024 * 1024
+        self.max_header = 64 * 1024
+        self.queue = asyncio.Queue(maxsize=max_queue)
+        self.metrics = Metrics()
+        # shortest input giving one WavLM frame: the receptive field of the conv feature extractor
+        self.min_samples = 1
+        for _, kernel_size, stride in reversed(eval(converter.cmodel.cfg.conv_feature_layers)):
+            self.min_samples = (self.min_samples - 1) * stride + kernel_size
+        # the models run in a single worker thread so the event loop keeps accepting requests
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        # uploads are decoded in their own threads, not queued behind model batches
+        self.decode_executor = ThreadPoolExecutor(max_workers=decode_workers)
+
+    # ---------------------------------------------------------------- batching
+    async def batcher(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            self.metrics.inc("batches_total")
+            self.metrics.inc("batch_items_total", len(batch))
+            await self.convert(batch)
+
+    async def convert(self, batch):
+        """Runs batch in the worker thread and resolves its futures"""
+        loop = asyncio.get_running_loop()
+        try:
+            audios = await loop.run_in_executor(self.executor, self.run_batch, batch)
+        except Exception as e:
+            if len(batch) > 1:
+                # one failing request must not fail the others batched with it
+                self.metrics.inc("batch_retries_total")
+                for item in batch:
+                    await self.convert([item])
+                return
+            _, _, future = batch[0]
+            if not future.done():
+                future.set_exception(e)
+            return
+        for (_, _, future), audio in zip(batch, audios):
+            if not future.done():
+                future.set_result(audio)
+
+    def target_embedding(self, target_id, wav_tgt):
+        if wav_tgt is not None:
+            return self.converter.speaker_embedding(wav_tgt)
+        if target_id not in self.target_cache:
+            wav_tgt = self.converter.load_wav(self.target_paths[target_id], trim=True)
+            self.target_cache[target_id] = self.converter.speaker_embedding(wav_tgt)
+        return self.target_cache[target_id]
+
+    def run_batch(self, batch):
+        wavs_src = [wav_src for wav_src, _, _ in batch]
+        g_tgt = torch.cat([self.target_embedding(*target) for _, target, _ in batch], dim=0)
+        return self.converter.convert_batch(wavs_src, g_tgt)
+
+    def decode_request(self, source, target):
+        """Source and optional target bytes -> (1, T) tensors, HTTPError 400 on invalid audio"""
+        sampling_rate = self.converter.sampling_rate
+        wav_src = decode_wav(source, sampling_rate)
+        wav_tgt = decode_wav(target, sampling_rate) if target is not None else None
+        for name, wav in (("source", wav_src), ("target", wav_tgt)):
+            if wav is not None and wav.size(-1) < self.min_samples:
+                raise HTTPError(400, "{} is {} samples, at least {} ({:.3f}s) are needed".format(
+                    name, wav.size(-1), self.min_samples, self.min_samples / sampling_rate))
+        return wav_src, wav_tgt
+
+    async def submit(self, wav_src, target):
+        if self.queue.full():
+            self.metrics.inc("rejected_total")
+            raise HTTPError(503, "conversion queue is full")
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((wav_src, target, future))
+        return await future
+
+    # ---------------------------------------------------------------- http
+    async def handle(self, reader, writer):
+        start = time.perf_counter()
+        path = None
+        try:
+            method, path, query, headers, body = await self.read_request(reader)
+            status, content_type, payload = await self.route(method, path, query, headers, body)
+        except HTTPError as e:
+            status, content_type, payload = e.status, "application/json", json.dumps({"error": str(e)}).encode()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        except Exception as e:
+            self.metrics.inc("errors_total")
+            status, content_type, payload = 500, "application/json", json.dumps({"error": repr(e)}).encode()
+
+        try:
+            await self.write_response(writer, status, content_type, payload)
+        finally:
+            writer.close()
+        if path == "/convert" and status == 200:
+            self.metrics.inc("request_seconds_sum", time.perf_counter() - start)
+            self.metrics.inc("request_seconds_count")
+
+    async def read_request(self, reader):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.LimitOverrunError:
+            raise HTTPError(431, "request headers exceed {} bytes".format(self.max_header))
+        lines = head.decode("latin-1").split("\r\n")
+        try:
+            method, target, _ = lines[0].split(" ", 2)
+        except ValueError:
+            raise HTTPError(400, "malformed request line")
+        headers = {}
+        for line in lines[1:]:
+            if ":" in line:
+                key, value = line.split(":", 1)
+                headers[key.strip().lower()] = value.strip()
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise HTTPError(400, "malformed content-length")
+        if length < 0:
+            raise HTTPError(400, "malformed content-length")
+        if length > self.max_body:
+            raise HTTPError(413, "request body exceeds {} bytes".format(self.max_body))
+        body = await reader.readexactly(length) if length else b""
+        url = urlsplit(target)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        return method, url.path, query, headers, body
+
+    async def write_response(self, writer, status, content_type, payload, chunk_size=64 * 1024):
+        writer.write("HTTP/1.1 {} {}\r\nContent-Type: {}\r\nTransfer-Encoding: chunked\r\nConnection: close\r\n\r\n".format(
+            status, STATUS.get(status, ""), content_type).encode())
+        # stream the payload back in chunks
+        for i in range(0, len(payload), chunk_size):
+            chunk = payload[i:i + chunk_size]
+            writer.write(b"%x\r\n%s\r\n" % (len(chunk), chunk))
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def route(self, method, path, query, headers, body):
+        if path == "/health":
+            return 200, "application/json", json.dumps({"status": "ok", "queue": self.queue.qsize()}).encode()
+        if path == "/metrics":
+            gauges = {"queue_depth": self.queue.qsize(), "queue_capacity": self.queue.maxsize}
+            text = self.metrics.prometheus(gauges)
+            if self.converter.timer is not None:
+                # stages only run in the worker thread, read here without locking
+                text += self.converter.timer.prometheus(prefix="linearvc_engine")
+            return 200, "text/plain; version=0.0.4", text.encode()
+        if path == "/targets":
+            return 200, "application/json", json.dumps(sorted(self.target_paths)).encode()
+        if path != "/convert":
+            raise HTTPError(404, "unknown path {}".format(path))
+        if method != "POST":
+            raise HTTPError(405, "use POST")
+
+        self.metrics.inc("requests_total")
+        sampling_rate = self.converter.sampling_rate
+        if headers.get("content-type", "").startswith("application/json"):
+            try:
+                request = json.loads(body)
+                source = base64.b64decode(request["source"], validate=True)
+                target = base64.b64decode(request["target"], validate=True) if "target" in request else None
+            except (ValueError, KeyError, TypeError) as e:
+                # binascii.Error (invalid base64) is a ValueError
+                raise HTTPError(400, "invalid json request: {!r}".format(e))
+            target_id = request.get("target_id")
+        else:
+            source, target, target_id = body, None, query.get("target_id")
+
+        if target is None and target_id not in self.target_paths:
+            raise HTTPError(404 if target_id else 400, "unknown target_id {}".format(target_id))
+
+        # decoding and resampling a large upload would stall every connection on the event loop
+        wav_src, wav_tgt = await asyncio.get_running_loop().run_in_executor(
+            self.decode_executor, self.decode_request, source, target)
+        audio = await self.submit(wav_src, (target_id, wav_tgt))
+        self.metrics.inc("audio_seconds_total", len(audio) / sampling_rate)
+        return 200, "audio/wav", encode_wav(audio, sampling_rate)
+
+    async def serve(self, host, port):
+        asyncio.get_running_loop().create_task(self.batcher())
+        server = await asyncio.start_server(self.handle, host, port, limit=self.max_header)
+        print("Serving on {}:{}".format(host, port))
+        async with server:
+            await server.serve_forever()
+
+
+def find_targets(target_dir):
+    """target id (file stem) -> wav path, for target_dir/*.wav and target_dir/*/*.wav"""
+    if target_dir is None:
+        return {}
+    paths = glob(os.path.join(target_dir, "*.wav")) + glob(os.path.join(target_dir, "*", "*.wav"))
+    return {os.path.splitext(os.path.basename(path))[0]: path for path in sorted(paths)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", type=str, default="./config/V9_VQ256_concat_5_40000.json", help="path to json config file")
+    parser.add_argument("--ptfile", type=str, required=True, help="path to pth file")
+    parser.add_argument("--device", type=str, default="cuda", help="device to run conversion on")
+    parser.add_argument("--precision", type=str, default="fp32", choices=["fp32", "bf16", "fp16"], help="autocast precision of WavLM and the generator")
+    parser.add_argument("--quantize", default=False, action="store_true", help="dynamic int8 WavLM content encoder (CPU only)")
+    parser.add_argument("--target_dir", type=str, default=None, help="dir of target wavs, addressed by file stem as target_id")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max_batch", type=int, default=8, help="max requests per batch")
+    parser.add_argument("--max_wait_ms", type=float, default=20, help="batching window after the first request")
+    parser.add_argument("--max_queue", type=int, default=64, help="waiting requests before rejecting with 503")
+    parser.add_argument("--decode_workers", type=int, default=2, help="threads decoding and resampling uploads")
+    parser.add_argument("--profile", default=False, action="store_true", help="export per-stage timings on /metrics")
+    parser.add_argument("--compile", default=False, action="store_true", help="torch.compile the generator")
+    parser.add_argument("--attention", type=str, default="default", help="WavLM attention backend: default / sdpa / chunked (long inputs)")
+    args = parser.parse_args()
+
+    hps = utils.get_hparams_from_file(args.config)
+    timer = StageTimer(args.device) if args.profile else None
+    converter = VoiceConverter(hps, args.ptfile, device=args.device, precision=args.precision, quantize=args.quantize, timer=timer, compile=args.compile, attention=args.attention)
+    server = ConversionServer(converter, find_targets(args.target_dir),
+                              max_batch=args.max_batch, max_wait_ms=args.max_wait_ms, max_queue=args.max_queue,
+                              decode_workers=args.decode_workers)
+    asyncio.run(server.serve(args.host, args.port))
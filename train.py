@@ -8,6 +8,7 @@ import sys, os
 import json
 import argparse
 import itertools
+import contextlib
 import math
 import torch
 from torch import nn, optim
@@ -19,12 +20,12 @@ from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.cuda.amp import autocast, GradScaler
 # import GPUtil
 
-import librosa
-
 # sys.path.append('/home/sim/VoiceConversion/ICASSP2025')
 # import utils.commons as commons
 from utils import commons
 from utils import utils
+from utils.checkpoint import CheckpointManager, latest_checkpoint, mmap_load
+from utils.ema import ModelEMA
 from utils.mel_processing import mel_spectrogram_torch, spec_to_mel_torch
 
 # 이부분 바뀜
@@ -44,20 +45,23 @@ from losses import (
 )
 
 
-import wandb
-
 
 torch.backends.cudnn.benchmark = True
 global_step = 0
 os.environ['TORCH_DISTRIBUTED_DEBUG'] = 'INFO'
 
 # os.environ['CUDA_LAUNCH_BLOCKING'] = '1'
-# os.environ["CUDA_VISIBLE_DEVICES"]="2"
-os.environ["CUDA_VISIBLE_DEVICES"]="3"
+# select GPUs with CUDA_VISIBLE_DEVICES when launching
+
+def get_device(hps, rank):
+  """train.device: cuda (default, one process per GPU) or cpu"""
+  if hps.train.get("device", "cuda") == "cpu":
+    return torch.device("cpu")
+  return torch.device("cuda", rank)
+
 
 def main():
-  """Assume Single Node Multi GPUs Training Only"""
-  assert torch.cuda.is_available(), "CPU training is not allowed."
+  """Single node training: one process per GPU, or train.num_processes CPU processes (gloo)"""
   # torch.multiprocessing.set_start_method('spawn')
   
   parser = argparse.ArgumentParser()
@@ -71,9 +75,14 @@ def main():
   
   hps = utils.get_hparams(args=args)
   
-  n_gpus = torch.cuda.device_count()
+  if get_device(hps, 0).type == "cuda":
+    assert torch.cuda.is_available(), "CUDA is not available, set train.device to cpu for CPU training."
+    n_gpus = torch.cuda.device_count()
+  else:
+    assert not hps.train.fp16_run, "fp16_run needs CUDA."
+    n_gpus = hps.train.get("num_processes", 1)
   os.environ['MASTER_ADDR'] = 'localhost'
-  os.environ['MASTER_PORT'] = hps.train.port
+  os.environ['MASTER_PORT'] = str(hps.train.port)
 
   # run(rank=0, ...)
   # run(0, n_gpus, hps)
@@ -85,16 +94,24 @@ def run(rank, n_gpus, hps):
   global global_step
   if rank == 0:
     if hps.setting.log_wandb:
+      # imported only when logging to wandb
+      import wandb
       wandb.init(project='Project_name',
                  name = hps.model_name)
     logger = utils.get_logger(hps.model_dir)
     logger.info(hps)
     utils.check_git_hash(hps.model_dir)
+    # None keeps every checkpoint
+    ckpt_manager = CheckpointManager(hps.model_dir,
+                                     keep_last=hps.train.get("keep_last_checkpoints"),
+                                     keep_best=hps.train.get("keep_best_checkpoints"))
   
-  torch.cuda.set_device(rank)
+  device = get_device(hps, rank)
+  if device.type == "cuda":
+    torch.cuda.set_device(rank)
 
-  
-  dist.init_process_group(backend='nccl', init_method='tcp://127.0.0.1:23460', world_size=n_gpus, rank=rank)
+  backend = hps.train.get("backend", "nccl" if device.type == "cuda" else "gloo")
+  dist.init_process_group(backend=backend, init_method='env://', world_size=n_gpus, rank=rank)
   torch.manual_seed(hps.train.seed)
 
 
@@ -110,7 +127,7 @@ def run(rank, n_gpus, hps):
   
   num_workers=hps.train.num_workers
   
-  train_loader = DataLoader(train_dataset, num_workers=num_workers, shuffle=False, pin_memory=True,
+  train_loader = DataLoader(train_dataset, num_workers=num_workers, shuffle=False, pin_memory=device.type == "cuda",
       collate_fn=collate_fn, batch_sampler=train_sampler)
   if rank == 0:
     eval_dataset = TextAudioSpeakerLoader(hps.data.validation_files, hps)
@@ -121,8 +138,13 @@ def run(rank, n_gpus, hps):
   net_g = SynthesizerTrn(
       hps.data.filter_length // 2 + 1,
       hps.train.segment_size // hps.data.hop_length,
-      **hps.model).cuda(rank)
-  net_d = MultiPeriodDiscriminator(hps.model.use_spectral_norm).cuda(rank)
+      **hps.model).to(device)
+  net_d = MultiPeriodDiscriminator(hps.model.use_spectral_norm).to(device)
+  if hps.train.get("compile", False):
+    # Generator and each sub-discriminator, the conv / leaky_relu / residual chains.
+    # Training only decodes segment_size crops: static shapes (the period
+    # reshape of DiscriminatorP does not trace with symbolic lengths)
+    commons.compile_([net_g.dec] + list(net_d.discriminators), dynamic=False)
   optim_g = torch.optim.AdamW(
       net_g.parameters(), 
       hps.train.learning_rate, 
@@ -134,18 +156,31 @@ def run(rank, n_gpus, hps):
       betas=hps.train.betas, 
       eps=hps.train.eps)
   
-  net_g = DDP(net_g, device_ids=[rank])#)
-  net_d = DDP(net_d, device_ids=[rank])
+  device_ids = [rank] if device.type == "cuda" else None
+  net_g = DDP(net_g, device_ids=device_ids)
+  net_d = DDP(net_d, device_ids=device_ids)
 
   
   try:
-    net_g, optim_g, _, epoch_str = utils.load_checkpoint(utils.latest_checkpoint_path(hps.model_dir, "G_*.pth"), net_g, optim_g)
-    net_d, optim_d, _, epoch_str = utils.load_checkpoint(utils.latest_checkpoint_path(hps.model_dir, "D_*.pth"), net_d, optim_d)
-    global_step = (epoch_str - 1) * len(train_loader)
+    # checkpoints.json written by CheckpointManager, globbing for older runs
+    g_path = latest_checkpoint(hps.model_dir, "G") or utils.latest_checkpoint_path(hps.model_dir, "G_*.pth")
+    d_path = latest_checkpoint(hps.model_dir, "D") or utils.latest_checkpoint_path(hps.model_dir, "D_*.pth")
+    net_g, optim_g, _, epoch_str = utils.load_checkpoint(g_path, net_g, optim_g)
+    net_d, optim_d, _, epoch_str = utils.load_checkpoint(d_path, net_d, optim_d)
+    global_step = (epoch_str - 1) * math.ceil(len(train_loader) / hps.train.get("grad_accum_steps", 1))
   except:
+    g_path = None
     epoch_str = 1
     global_step = 0
 
+  # EMA of the generator weights, kept by rank 0 only (weights are identical across ranks)
+  ema = None
+  if rank == 0 and hps.train.get("ema_decay"):
+    ema = ModelEMA(net_g, hps.train.ema_decay, hps.train.get("ema_every", 1))
+    ema_state = mmap_load(g_path).get("model_ema") if g_path is not None else None
+    if ema_state is not None:
+      ema.load_state_dict(ema_state)
+
   scheduler_g = torch.optim.lr_scheduler.ExponentialLR(optim_g, gamma=hps.train.lr_decay, last_epoch=epoch_str-2)
   scheduler_d = torch.optim.lr_scheduler.ExponentialLR(optim_d, gamma=hps.train.lr_decay, last_epoch=epoch_str-2)
 
@@ -153,14 +188,17 @@ def run(rank, n_gpus, hps):
 
   for epoch in range(epoch_str, hps.train.epochs + 1):
     if rank==0:
-      train_and_evaluate(rank, epoch, hps, [net_g, net_d], [optim_g, optim_d], [scheduler_g, scheduler_d], scaler, [train_loader, eval_loader], logger)
+      train_and_evaluate(rank, epoch, hps, [net_g, net_d], [optim_g, optim_d], [scheduler_g, scheduler_d], scaler, [train_loader, eval_loader], logger, ckpt_manager, ema)
     else:
-      train_and_evaluate(rank, epoch, hps, [net_g, net_d], [optim_g, optim_d], [scheduler_g, scheduler_d], scaler, [train_loader, None], None, None)
+      train_and_evaluate(rank, epoch, hps, [net_g, net_d], [optim_g, optim_d], [scheduler_g, scheduler_d], scaler, [train_loader, None], None)
     scheduler_g.step()
     scheduler_d.step()
 
+  if rank == 0:
+    ckpt_manager.wait()
+
 
-def train_and_evaluate(rank, epoch, hps, nets, optims, schedulers, scaler, loaders, logger):
+def train_and_evaluate(rank, epoch, hps, nets, optims, schedulers, scaler, loaders, logger, ckpt_manager=None, ema=None):
   '''
   Args:
     c: content embedding (ssl output) (N, z_dim, T) : (batch, 1024, T)
@@ -173,6 +211,7 @@ def train_and_evaluate(rank, epoch, hps, nets, optims, schedulers, scaler, loade
   optim_g, optim_d = optims
   scheduler_g, scheduler_d = schedulers
   train_loader, eval_loader = loaders
+  device = next(net_g.parameters()).device
 
 
   train_loader.batch_sampler.set_epoch(epoch)
@@ -180,73 +219,42 @@ def train_and_evaluate(rank, epoch, hps, nets, optims, schedulers, scaler, loade
 
   net_g.train()
   net_d.train()
+
+  # optimizer steps every grad_accum_steps batches (and at the end of the epoch)
+  grad_accum_steps = hps.train.get("grad_accum_steps", 1)
   
   for batch_idx, items in enumerate(train_loader):
-
-    c, spec, y = items
-    
-    spec, y = spec.cuda(rank), y.cuda(rank)
-    c = c.cuda(rank)
-    
-    mel = spec_to_mel_torch(
-      spec, 
-      hps.data.filter_length, 
-      hps.data.n_mel_channels, 
-      hps.data.sampling_rate,
-      hps.data.mel_fmin, 
-      hps.data.mel_fmax)
-    
-    with autocast(enabled=hps.train.fp16_run):
-      # Generator -> y_hat
-      # g: None, mel: None
-      y_hat, ids_slice, (commit_loss, perplexity) = net_g(c)
-      
-      if ids_slice != None:
-        y_mel = commons.slice_segments(mel, ids_slice, hps.train.segment_size // hps.data.hop_length) # 28 mel length
-      else:
-        y_mel = mel
-        
-      y_hat_mel = mel_spectrogram_torch(
-          y_hat.squeeze(1), 
-          hps.data.filter_length, 
-          hps.data.n_mel_channels, 
-          hps.data.sampling_rate, 
-          hps.data.hop_length, 
-          hps.data.win_length, 
-          hps.data.mel_fmin, 
-          hps.data.mel_fmax
-      )
-      if ids_slice != None:
-        y = commons.slice_segments(y, ids_slice * hps.data.hop_length, hps.train.segment_size)
-      
-      
-      # Discriminator loss
-      y_d_hat_r, y_d_hat_g, _, _ = net_d(y, y_hat.detach())
-      with autocast(enabled=False):
-        # LS-GAN loss
-        loss_disc, losses_disc_r, losses_disc_g = discriminator_loss(y_d_hat_r, y_d_hat_g)
-        loss_disc_all = loss_disc
-    optim_d.zero_grad()
-    scaler.scale(loss_disc_all).backward()
-    scaler.unscale_(optim_d)
-    grad_norm_d = commons.clip_grad_value_(net_d.parameters(), None)
-    scaler.step(optim_d)
-
-    # Generator loss
-    with autocast(enabled=hps.train.fp16_run):
-      y_d_hat_r, y_d_hat_g, fmap_r, fmap_g = net_d(y, y_hat)
-      with autocast(enabled=False):
-        loss_mel = F.l1_loss(y_mel, y_hat_mel) * hps.train.c_mel
-        loss_fm = feature_loss(fmap_r, fmap_g) 
-        loss_gen, losses_gen = generator_loss(y_d_hat_g) #LS-GAN loss
-        loss_gen_all = loss_gen + loss_fm + loss_mel
-        
-    optim_g.zero_grad()
-    scaler.scale(loss_gen_all).backward()
+    micro_step = batch_idx % grad_accum_steps
+    accum_steps = min(grad_accum_steps, len(train_loader) - (batch_idx - micro_step))
+    is_update = micro_step == accum_steps - 1
+    if micro_step == 0:
+      optim_d.zero_grad()
+      optim_g.zero_grad()
+
+    # gradients are only allreduced on the last micro-step of an update
+    sync_context = contextlib.ExitStack()
+    if not is_update:
+      sync_context.enter_context(net_g.no_sync())
+      sync_context.enter_context(net_d.no_sync())
+    with sync_context:
+      # a single micro-batch update steps D inside train_step, before the G loss
+      y_mel, y_hat_mel, mel, losses, perplexity, grad_norm_d = train_step(
+        hps, device, net_g, net_d, items, scaler, accum_steps,
+        optim_d=optim_d if accum_steps == 1 else None)
+    loss_disc, loss_gen, loss_fm, loss_mel = losses
+    if not is_update:
+      continue
+
+    if accum_steps > 1:
+      scaler.unscale_(optim_d)
+      grad_norm_d = commons.clip_grad_value_(net_d.parameters(), None)
+      scaler.step(optim_d)
     scaler.unscale_(optim_g)
     grad_norm_g = commons.clip_grad_value_(net_g.parameters(), None)
     scaler.step(optim_g)
     scaler.update()
+    if ema is not None:
+      ema.update(net_g, global_step)
 
     if rank==0:
       if global_step % hps.train.log_interval == 0:
@@ -256,9 +264,13 @@ def train_and_evaluate(rank, epoch, hps, nets, optims, schedulers, scaler, loade
         logger.info('Train Epoch: {} [{:.0f}%]'.format(
           epoch,
           100. * batch_idx / len(train_loader)))
-        logger.info([x.item() for x in losses] + [global_step, lr])
+        # the only host sync of the step, on log steps
+        losses = torch.stack([x.detach().float() for x in losses]).tolist()
+        grad_norm_d, grad_norm_g = torch.stack([grad_norm_d, grad_norm_g]).tolist()
+        logger.info(losses + [global_step, lr])
         
         if hps.setting.log_wandb:
+          import wandb
           wandb.log({
             "learning_rate": lr,
             "grad_norm_d": grad_norm_d,
@@ -271,32 +283,125 @@ def train_and_evaluate(rank, epoch, hps, nets, optims, schedulers, scaler, loade
           })
     
       if global_step % hps.train.eval_interval == 0:
-        evaluate(hps, [net_g, net_d], eval_loader)
-        utils.save_checkpoint(net_g, optim_g, hps.train.learning_rate, epoch, os.path.join(hps.model_dir, "G_{}.pth".format(global_step)))
-        utils.save_checkpoint(net_d, optim_d, hps.train.learning_rate, epoch, os.path.join(hps.model_dir, "D_{}.pth".format(global_step)))
+        # evaluated with the EMA weights when enabled
+        with ema.apply_to(net_g) if ema is not None else contextlib.nullcontext():
+          eval_mel_loss = evaluate(hps, [net_g, net_d], eval_loader)
+        # snapshot to CPU here, written in the background
+        ckpt_manager.save(global_step, {"G": (net_g, optim_g), "D": (net_d, optim_d)},
+                          hps.train.learning_rate, epoch, metric=eval_mel_loss,
+                          extra={"G": {"model_ema": ema.state_dict()}} if ema is not None else None)
     global_step += 1
   
   if rank == 0:
     logger.info('====> Epoch: {}'.format(epoch))
 
+
+def train_step(hps, device, net_g, net_d, items, scaler, accum_steps, optim_d=None):
+  '''
+  Forward and backward of one micro-batch, gradients accumulate until the optimizer step.
+  Losses are divided by accum_steps so that an update averages its micro-batches.
+
+  optim_d: given for an update of one micro-batch (grad_accum_steps 1). D then steps
+  before the G loss, which is computed against the updated D as in plain GAN training;
+  the D grad norm is returned. Without it (accumulation) D steps with G after the last
+  micro-batch, so the G losses of an update see the D of the previous update, and the
+  real-audio feature maps of the D pass are reused.
+  '''
+  c, spec, y = items
+  
+  spec, y = spec.to(device), y.to(device)
+  c = c.to(device)
+  
+  mel = spec_to_mel_torch(
+    spec, 
+    hps.data.filter_length, 
+    hps.data.n_mel_channels, 
+    hps.data.sampling_rate,
+    hps.data.mel_fmin, 
+    hps.data.mel_fmax)
+  
+  with autocast(enabled=hps.train.fp16_run):
+    # Generator -> y_hat
+    # g: None, mel: None
+    y_hat, ids_slice, (commit_loss, perplexity) = net_g(c)
+    
+    if ids_slice != None:
+      y_mel = commons.slice_segments(mel, ids_slice, hps.train.segment_size // hps.data.hop_length) # 28 mel length
+    else:
+      y_mel = mel
+      
+    y_hat_mel = mel_spectrogram_torch(
+        y_hat.squeeze(1), 
+        hps.data.filter_length, 
+        hps.data.n_mel_channels, 
+        hps.data.sampling_rate, 
+        hps.data.hop_length, 
+        hps.data.win_length, 
+        hps.data.mel_fmin, 
+        hps.data.mel_fmax
+    )
+    if ids_slice != None:
+      y = commons.slice_segments(y, ids_slice * hps.data.hop_length, hps.train.segment_size)
+    
+    
+    # Discriminator loss
+    y_d_hat_r, y_d_hat_g, fmap_r, _ = net_d(y, y_hat.detach())
+    with autocast(enabled=False):
+      # LS-GAN loss
+      loss_disc, losses_disc_r, losses_disc_g = discriminator_loss(y_d_hat_r, y_d_hat_g)
+      loss_disc_all = loss_disc
+  scaler.scale(loss_disc_all / accum_steps).backward()
+  grad_norm_d = None
+  if optim_d is not None:
+    scaler.unscale_(optim_d)
+    grad_norm_d = commons.clip_grad_value_(net_d.parameters(), None)
+    scaler.step(optim_d)
+  # real-audio feature maps are the feature matching targets of the G loss
+  fmap_r = [[x.detach() for x in fmap] for fmap in fmap_r]
+
+  # Generator loss
+  # D runs outside DDP with frozen parameters: the G loss must not add to the
+  # D gradients accumulated for this update
+  commons.set_requires_grad(net_d, False)
+  with autocast(enabled=hps.train.fp16_run):
+    if optim_d is not None:
+      # D was just updated: real-audio targets from the updated D too, so this
+      # path pays the real-audio D pass again (the reuse only saves it with accumulation)
+      _, y_d_hat_g, fmap_r, fmap_g = net_d.module(y, y_hat)
+    else:
+      y_d_hat_g, fmap_g = net_d.module.forward_single(y_hat)
+    with autocast(enabled=False):
+      loss_mel = F.l1_loss(y_mel, y_hat_mel) * hps.train.c_mel
+      loss_fm = feature_loss(fmap_r, fmap_g) 
+      loss_gen, losses_gen = generator_loss(y_d_hat_g) #LS-GAN loss
+      loss_gen_all = loss_gen + loss_fm + loss_mel
+      
+  scaler.scale(loss_gen_all / accum_steps).backward()
+  commons.set_requires_grad(net_d, True)
+
+  return y_mel, y_hat_mel, mel, (loss_disc, loss_gen, loss_fm, loss_mel), perplexity, grad_norm_d
+
  
 def evaluate(hps, nets, eval_loader):
 
     generator, net_d = nets
+    device = next(generator.parameters()).device
     
     generator.eval()
     
     losses_list = [0, 0, 0, 0]
     
-    with torch.no_grad():
+    # eval utterances have every length: compiled dec / discriminators (train.compile)
+    # are static-shape and would recompile for each one
+    with torch.no_grad(), commons.eager():
       for batch_idx, items in enumerate(eval_loader):
-        print('Evaluate GPU')
+        print('Evaluate')
 
         c, spec, y = items
         break
 
-      spec, y = spec.cuda(0), y.cuda(0)
-      c = c.cuda(0)
+      spec, y = spec.to(device), y.to(device)
+      c = c.to(device)
 
       
       mel = spec_to_mel_torch(
@@ -322,7 +427,7 @@ def evaluate(hps, nets, eval_loader):
       )
       
       # Discriminator loss
-      y_d_hat_r, y_d_hat_g, _, _ = net_d(y, y_hat.detach())
+      y_d_hat_r, y_d_hat_g, fmap_r, fmap_g = net_d(y, y_hat)
       with autocast(enabled=False):
         # LS-GAN loss
         loss_disc, losses_disc_r, losses_disc_g = discriminator_loss(y_d_hat_r, y_d_hat_g)
@@ -330,8 +435,7 @@ def evaluate(hps, nets, eval_loader):
         losses_list[0] += loss_disc_all
         
       with autocast(enabled=hps.train.fp16_run):
-      # Generator, fmap_r: discriminator의 layer 별 output for y, fmap_g: for y_hat
-        y_d_hat_r, y_d_hat_g, fmap_r, fmap_g = net_d(y, y_hat)
+      # Generator, fmap_r: discriminator의 layer 별 output for y, fmap_g: for y_hat (no grad: the same D outputs)
         with autocast(enabled=False):
           loss_mel = F.l1_loss(mel, y_hat_mel) * hps.train.c_mel
           loss_fm = feature_loss(fmap_r, fmap_g)
@@ -342,6 +446,7 @@ def evaluate(hps, nets, eval_loader):
           losses_list[3] += loss_mel
     
     if hps.setting.log_wandb:
+      import wandb
       wandb.log({
             "eval_loss/d_total": losses_list[0].detach().cpu().numpy(),
             "eval_loss/g_total": losses_list[1].detach().cpu().numpy(),
@@ -352,6 +457,7 @@ def evaluate(hps, nets, eval_loader):
       })
     
     generator.train()
+    return losses_list[3].item()
 
                            
 if __name__ == "__main__":
@@ -3,6 +3,14 @@
 #     from utils import mel_processing
 #     from utils import utils
 # except:
-from . import commons
-from . import mel_processing
-from . import utils
\ No newline at end of file
+# submodules are imported on first use (PEP 562): a conversion worker
+# importing utils.audio does not load librosa or the training helpers
+import importlib
+
+_SUBMODULES = ("commons", "mel_processing", "utils")
+
+
+def __getattr__(name):
+  if name in _SUBMODULES:
+    return importlib.import_module("." + name, __name__)
+  raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
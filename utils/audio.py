@@ -0,0 +1,75 @@
+"""
+Audio decoding and resampling shared by conversion, preprocessing and training.
+
+  wav, sr = load(path, sr=16000)              # float32 (T,) in [-1, 1], resampled once if needed
+  wav, sr = decode(wav_bytes, sr=16000)       # same, from an in-memory file (server requests)
+  for path, wav in load_many(paths, sr=16000):  # decoded ahead in a thread pool
+    ...
+
+Files are decoded by soundfile (libsndfile) straight into float32, without
+librosa / audioread / numba. Resampling is scipy's polyphase resample_poly
+with its anti-aliasing filter designed once per (orig_sr, target_sr).
+"""
+import io
+from math import gcd
+from functools import lru_cache
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import soundfile as sf
+
+
+@lru_cache(maxsize=16)
+def resample_filter(orig_sr, target_sr):
+    """(up, down, FIR taps) of resample_poly's default filter for orig_sr -> target_sr"""
+    from scipy.signal import firwin
+    g = gcd(orig_sr, target_sr)
+    up, down = target_sr // g, orig_sr // g
+    max_rate = max(up, down)
+    half_len = 10 * max_rate
+    taps = firwin(2 * half_len + 1, 1. / max_rate, window=("kaiser", 5.0)).astype(np.float32)
+    taps.setflags(write=False)
+    return up, down, taps
+
+
+def resample(wav, orig_sr, target_sr):
+    """resample_poly(wav, up, down) of a float32 (T,) array, with the filter designed once per rate pair"""
+    if orig_sr == target_sr:
+        return wav
+    # scipy.signal is imported on the first resample, not for native-rate decoding
+    from scipy.signal import resample_poly
+    up, down, taps = resample_filter(orig_sr, target_sr)
+    return resample_poly(wav, up, down, window=taps).astype(np.float32, copy=False)
+
+
+def _read(file, sr):
+    wav, orig_sr = sf.read(file, dtype="float32", always_2d=True)
+    wav = wav[:, 0] if wav.shape[1] == 1 else wav.mean(axis=1)
+    if sr is None:
+        return np.ascontiguousarray(wav), orig_sr
+    return resample(wav, orig_sr, sr), sr
+
+
+def load(path, sr=None):
+    """float32 (T,) in [-1, 1] (channels averaged) and its rate, resampled to sr if given"""
+    return _read(path, sr)
+
+
+def decode(data, sr=None):
+    """load for encoded bytes (wav / flac / ogg); raises RuntimeError on invalid data"""
+    return _read(io.BytesIO(data), sr)
+
+
+def load_many(paths, sr=None, num_workers=4, prefetch=16):
+    """Yields (path, wav) in the order of paths, decoding up to prefetch files ahead in num_workers threads"""
+    with ThreadPoolExecutor(num_workers) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append((path, pool.submit(load, path, sr)))
+            if len(pending) >= prefetch:
+                path, future = pending.popleft()
+                yield path, future.result()[0]
+        while pending:
+            path, future = pending.popleft()
+            yield path, future.result()[0]
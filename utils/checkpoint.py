@@ -0,0 +1,240 @@
+"""
+Checkpoint manager for training.
+
+  - state is snapshotted to CPU on the calling thread, serialised in a
+    background thread (one write in flight)
+  - files are written to a temp file and renamed, a crash never leaves a
+    truncated G_*.pth behind
+  - keeps the last keep_last and the best keep_best (lowest metric) checkpoints,
+    and always the newest one, which resume continues from
+  - checkpoints.json indexes the kept checkpoints, resume reads it instead of
+    globbing the directory
+
+Files keep the utils.save_checkpoint format, so utils.load_checkpoint reads them.
+
+For serving, export_slim writes a weights-only copy of a G checkpoint:
+
+  python -m utils.checkpoint logs/model/G_700000.pth G_700000_slim.pth [--half] [--ema]
+
+and export_cmodel a WavLM checkpoint prepared for inference (see
+WavLM.prepare_for_inference), loaded by utils.get_cmodel without the preparation:
+
+  python -m utils.checkpoint WavLM-Large.pt WavLM-Large_inference.pt --cmodel
+"""
+import os
+import json
+import pickle
+import logging
+import argparse
+import threading
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+INDEX_FILE = "checkpoints.json"
+
+
+def to_cpu(obj):
+    """Detached CPU copy of every tensor in nested dicts / lists (state dicts, optimizer state)"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def atomic_save(obj, path):
+    tmp_path = path + ".tmp"
+    torch.save(obj, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def mmap_load(path):
+    """
+    torch.load with the file memory-mapped: tensors are paged in when used, so
+    entries that are never read (e.g. optimizer state at inference) cost no I/O
+    """
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=True)
+    except (RuntimeError, pickle.UnpicklingError):
+        # legacy (non-zip) files cannot be mapped
+        return torch.load(path, map_location="cpu")
+
+
+def export_slim(checkpoint_path, out_path, half=False, ema=False):
+    """
+    Weights-only copy of a training checkpoint (no optimizer state), optionally in fp16
+    ema: export the EMA generator weights ('model_ema') instead of the trained ones
+    """
+    checkpoint = mmap_load(checkpoint_path)
+    if ema:
+        assert "model_ema" in checkpoint, "{} has no EMA weights".format(checkpoint_path)
+    model = checkpoint["model_ema"] if ema else checkpoint["model"]
+    if half:
+        model = {k: v.half() if v.is_floating_point() else v for k, v in model.items()}
+    slim = {
+        "model": {k: v.clone() for k, v in model.items()},
+        "iteration": checkpoint["iteration"],
+        "learning_rate": checkpoint["learning_rate"],
+        "optimizer": None,
+    }
+    atomic_save(slim, out_path)
+    return out_path
+
+
+def export_cmodel(checkpoint_path, out_path):
+    """WavLM checkpoint -> content encoder prepared for inference, flagged 'prepared'"""
+    from wavlm import WavLM, WavLMConfig
+
+    checkpoint = mmap_load(checkpoint_path)
+    assert not checkpoint.get("prepared", False), "{} is already prepared".format(checkpoint_path)
+    cmodel = WavLM(WavLMConfig(checkpoint["cfg"]))
+    cmodel.load_state_dict(checkpoint["model"])
+    cmodel.prepare_for_inference()
+    atomic_save({"cfg": checkpoint["cfg"], "model": cmodel.state_dict(), "prepared": True}, out_path)
+    return out_path
+
+
+def read_index(model_dir):
+    path = os.path.join(model_dir, INDEX_FILE)
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def latest_checkpoint(model_dir, prefix="G"):
+    """Path of the latest checkpoint of prefix from the index, None without an index"""
+    index = read_index(model_dir)
+    if not index or not index["checkpoints"]:
+        return None
+    latest = max(index["checkpoints"], key=lambda c: c["step"])
+    return os.path.join(model_dir, latest["files"][prefix])
+
+
+class CheckpointManager():
+    """
+    manager = CheckpointManager(model_dir, keep_last=5, keep_best=2)
+    manager.save(step, {"G": (net_g, optim_g), "D": (net_d, optim_d)}, learning_rate, epoch, metric=mel_loss)
+    ...
+    manager.wait()
+
+    keep_last / keep_best: both None keeps every checkpoint. Otherwise the newest
+    checkpoint is always kept (keep_last counts as at least 1), so resume never
+    falls back to an older step because the latest one is not among the best
+    """
+    def __init__(self, model_dir, keep_last=None, keep_best=None, async_write=True):
+        self.model_dir = model_dir
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.async_write = async_write
+        self.index = read_index(model_dir) or {"checkpoints": []}
+        self._thread = None
+        self._error = None
+
+    def save(self, step, models, learning_rate, iteration, metric=None, extra=None):
+        """
+        models: {prefix: (model, optimizer)}, model may be DDP wrapped
+        iteration: stored as 'iteration' (train.py stores the epoch, used on resume)
+        extra: {prefix: {key: state}} additional entries of a prefix's file, e.g. {"G": {"model_ema": ...}}
+        """
+        snapshots = {}
+        for prefix, (model, optimizer) in models.items():
+            model = model.module if hasattr(model, "module") else model
+            snapshot = {
+                "model": to_cpu(model.state_dict()),
+                "iteration": iteration,
+                "optimizer": to_cpu(optimizer.state_dict()) if optimizer is not None else None,
+                "learning_rate": learning_rate,
+            }
+            snapshot.update(to_cpu((extra or {}).get(prefix, {})))
+            snapshots[prefix] = snapshot
+
+        # one write in flight: bounds the CPU memory held by snapshots
+        self.wait()
+        if self.async_write:
+            self._thread = threading.Thread(target=self._write, args=(step, iteration, metric, snapshots))
+            self._thread.start()
+        else:
+            self._write(step, iteration, metric, snapshots)
+            self._raise()
+
+    def _write(self, step, iteration, metric, snapshots):
+        try:
+            files = {}
+            for prefix, snapshot in snapshots.items():
+                files[prefix] = "{}_{}.pth".format(prefix, step)
+                logger.info("Saving model and optimizer state at iteration {} to {}".format(
+                    iteration, os.path.join(self.model_dir, files[prefix])))
+                atomic_save(snapshot, os.path.join(self.model_dir, files[prefix]))
+
+            checkpoints = [c for c in self.index["checkpoints"] if c["step"] != step]
+            checkpoints.append({"step": step, "iteration": iteration, "metric": metric, "files": files})
+            kept, removed = self._retain(checkpoints)
+            self.index = {"checkpoints": kept}
+            self._write_index()
+            for checkpoint in removed:
+                for name in checkpoint["files"].values():
+                    path = os.path.join(self.model_dir, name)
+                    if os.path.isfile(path):
+                        os.remove(path)
+        except Exception as e:
+            self._error = e
+
+    def _retain(self, checkpoints):
+        checkpoints = sorted(checkpoints, key=lambda c: c["step"])
+        if self.keep_last is None and self.keep_best is None:
+            return checkpoints, []
+        keep = set()
+        keep_last = max(self.keep_last or 0, 1)
+        keep.update(c["step"] for c in checkpoints[-keep_last:])
+        if self.keep_best is not None and self.keep_best > 0:
+            scored = [c for c in checkpoints if c["metric"] is not None]
+            keep.update(c["step"] for c in sorted(scored, key=lambda c: c["metric"])[:self.keep_best])
+        return [c for c in checkpoints if c["step"] in keep], [c for c in checkpoints if c["step"] not in keep]
+
+    def _write_index(self):
+        path = os.path.join(self.model_dir, INDEX_FILE)
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def _raise(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def wait(self):
+        """Blocks until the pending write is done, re-raises its error"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._raise()
+
+    def best(self, prefix="G"):
+        scored = [c for c in self.index["checkpoints"] if c["metric"] is not None]
+        if not scored:
+            return None
+        return os.path.join(self.model_dir, min(scored, key=lambda c: c["metric"])["files"][prefix])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("checkpoint_path", type=str, help="G_*.pth training checkpoint (WavLM checkpoint with --cmodel)")
+    parser.add_argument("out_path", type=str, help="path to the slim checkpoint")
+    parser.add_argument("--half", default=False, action="store_true", help="store floating point weights in fp16")
+    parser.add_argument("--ema", default=False, action="store_true", help="export the EMA generator weights")
+    parser.add_argument("--cmodel", default=False, action="store_true", help="export a WavLM content encoder prepared for inference")
+    args = parser.parse_args()
+
+    if args.cmodel:
+        assert not (args.half or args.ema), "--half / --ema apply to generator checkpoints"
+        export_cmodel(args.checkpoint_path, args.out_path)
+    else:
+        export_slim(args.checkpoint_path, args.out_path, half=args.half, ema=args.ema)
+    print("{} ({:.1f} MB) -> {} ({:.1f} MB)".format(
+        args.checkpoint_path, os.path.getsize(args.checkpoint_path) / 2 ** 20,
+        args.out_path, os.path.getsize(args.out_path) / 2 ** 20))
@@ -46,12 +46,9 @@ def rand_gumbel_like(x):
 
 
 def slice_segments(x, ids_str, segment_size=4):
-  ret = torch.zeros_like(x[:, :, :segment_size])
-  for i in range(x.size(0)):
-    idx_str = ids_str[i]
-    idx_end = idx_str + segment_size
-    ret[i] = x[i, :, idx_str:idx_end]
-  return ret
+  # one gather instead of per-item slicing, which syncs on device ids_str
+  ids = torch.as_tensor(ids_str, device=x.device).view(-1, 1, 1) + torch.arange(segment_size, device=x.device)
+  return torch.gather(x, 2, ids.expand(x.size(0), x.size(1), segment_size))
 
 
 def rand_slice_segments(x, x_lengths=None, segment_size=4):
@@ -153,19 +150,53 @@ def generate_path(duration, mask):
   return path
 
 
+def compile_(modules, dynamic=True, mode=None):
+  """
+  torch.compile each module in place (nn.Module.compile, state_dict keys are unchanged).
+  dynamic=True: symbolic input lengths, one graph per length range guarded by the conv
+  backend choice (a few in total) instead of a recompile per length
+  """
+  modules = list(modules)
+  # instances of one class share forward's code object and its graph cache
+  # (e.g. the five DiscriminatorP), each instance needs its own entries
+  config = torch._dynamo.config
+  name = "recompile_limit" if hasattr(config, "recompile_limit") else "cache_size_limit"
+  setattr(config, name, max(getattr(config, name), 4 * len(modules)))
+  for m in modules:
+    m.compile(dynamic=dynamic, mode=mode)
+
+
+def eager():
+  """
+  Context in which modules compiled by compile_ run their original forward, e.g. eval
+  of full-length utterances through modules compiled for the static training crop
+  """
+  if hasattr(torch.compiler, "set_stance"):
+    return torch.compiler.set_stance("force_eager")
+  return torch._dynamo.config.patch(disable=True)
+
+
+def set_requires_grad(module, requires_grad):
+  for p in module.parameters():
+    p.requires_grad_(requires_grad)
+
+
 def clip_grad_value_(parameters, clip_value, norm_type=2):
+  """
+  Clamps gradients to [-clip_value, clip_value] and returns the total gradient norm
+  (before clamping) as a device tensor, without host syncs: call .item() only when logging
+  """
   if isinstance(parameters, torch.Tensor):
     parameters = [parameters]
-  parameters = list(filter(lambda p: p.grad is not None, parameters))
+  parameters = list(parameters)
+  grads = [p.grad.data for p in parameters if p.grad is not None]
   norm_type = float(norm_type)
+  if len(grads) == 0:
+    return torch.tensor(0., device=parameters[0].device if parameters else None)
+
+  total_norm = torch.linalg.vector_norm(torch.stack(torch._foreach_norm(grads, norm_type)), norm_type)
   if clip_value is not None:
     clip_value = float(clip_value)
-
-  total_norm = 0
-  for p in parameters:
-    param_norm = p.grad.data.norm(norm_type)
-    total_norm += param_norm.item() ** norm_type
-    if clip_value is not None:
-      p.grad.data.clamp_(min=-clip_value, max=clip_value)
-  total_norm = total_norm ** (1. / norm_type)
+    torch._foreach_clamp_min_(grads, -clip_value)
+    torch._foreach_clamp_max_(grads, clip_value)
   return total_norm
@@ -1,29 +1,50 @@
+"""
+Downsamples a corpus (speaker/*<suffix>) to 16 kHz wavs (speaker/*.wav).
+
+  - decodes at the native rate and resamples once (polyphase)
+  - all files of all speakers go through one process pool
+  - outputs that already exist are skipped (--overwrite to redo them)
+  - writes a manifest of the outputs: path|duration in seconds
+
+  python -m utils.downsample --in_dir VCTK-Corpus/wav48_silence_trimmed --out_dir1 vctk-16k --sr1 16000
+"""
 import os
 import argparse
-import librosa
-import numpy as np
+from glob import glob
 from multiprocessing import Pool, cpu_count
+
+import numpy as np
+import soundfile as sf
 from scipy.io import wavfile
 from tqdm import tqdm
 
+from utils import audio
+
 
-def process(wav_name):
-    speaker = wav_name[:4]
-    wav_path = os.path.join(args.in_dir, wav_name)
-    if os.path.exists(wav_path) and '_mic2.flac' in wav_path:
-        os.makedirs(os.path.join(args.out_dir1, speaker), exist_ok=True)
-        wav, sr = librosa.load(wav_path)
-        peak = np.abs(wav).max()
-        if peak > 1.0:
-            wav = 0.98 * wav / peak
-        wav1 = librosa.resample(wav, orig_sr=sr, target_sr=args.sr1)
-        save_name = wav_name.replace("_mic2.flac", ".wav")
-        save_path1 = os.path.join(args.out_dir1, save_name)
-        wavfile.write(
-            save_path1,
-            args.sr1,
-            (wav1 * np.iinfo(np.int16).max).astype(np.int16)
-        )
+def save_path(wav_path):
+    speaker = os.path.basename(os.path.dirname(wav_path))
+    save_name = os.path.basename(wav_path).replace(args.suffix, ".wav")
+    return os.path.join(args.out_dir1, speaker, save_name)
+
+
+def process(wav_path):
+    """Returns (output path, duration in seconds)"""
+    save_path1 = save_path(wav_path)
+    if os.path.exists(save_path1) and not args.overwrite:
+        return save_path1, sf.info(save_path1).duration
+
+    wav, sr = audio.load(wav_path)
+    peak = np.abs(wav).max()
+    if peak > 1.0:
+        wav = 0.98 * wav / peak
+    wav1 = audio.resample(wav, sr, args.sr1)
+    os.makedirs(os.path.dirname(save_path1), exist_ok=True)
+    wavfile.write(
+        save_path1,
+        args.sr1,
+        (np.clip(wav1, -1.0, 1.0) * np.iinfo(np.int16).max).astype(np.int16)
+    )
+    return save_path1, len(wav1) / args.sr1
 
 
 if __name__ == "__main__":
@@ -31,13 +52,21 @@ if __name__ == "__main__":
     parser.add_argument("--sr1", type=int, default=16000, help="sampling rate")
     parser.add_argument("--in_dir", type=str, default="./data_sample/VCTK", help="path to source dir")
     parser.add_argument("--out_dir1", type=str, default="./data_sample/preprocessed", help="path to target dir")
-
+    parser.add_argument("--suffix", type=str, default="_mic2.flac", help="source files are speaker/*<suffix>")
+    parser.add_argument("--num_workers", type=int, default=max(1, cpu_count() - 2), help="processes")
+    parser.add_argument("--overwrite", default=False, action="store_true", help="redo existing outputs")
+    parser.add_argument("--manifest", type=str, default=None, help="path to manifest, <out_dir1>/manifest.txt if not given")
     args = parser.parse_args()
 
-    pool = Pool(processes=cpu_count()-2)
+    wav_paths = sorted(glob(os.path.join(args.in_dir, "*", "*" + args.suffix)))
+    print("{} files".format(len(wav_paths)))
+
+    with Pool(processes=args.num_workers) as pool:
+        results = list(tqdm(pool.imap_unordered(process, wav_paths, chunksize=16), total=len(wav_paths)))
 
-    for speaker in os.listdir(args.in_dir):
-        spk_dir = os.path.join(args.in_dir, speaker)
-        if os.path.isdir(spk_dir):
-            for _ in tqdm(pool.imap_unordered(process, os.listdir(spk_dir))):
-                pass
+    manifest = args.manifest or os.path.join(args.out_dir1, "manifest.txt")
+    os.makedirs(os.path.dirname(os.path.abspath(manifest)), exist_ok=True)
+    with open(manifest, "w", encoding="utf-8") as f:
+        for path, duration in sorted(results):
+            f.write("{}|{:.3f}\n".format(path, duration))
+    print("{:.2f} hours -> {}".format(sum(d for _, d in results) / 3600, manifest))
@@ -0,0 +1,62 @@
+"""
+Exponential moving average of generator weights.
+
+  ema = ModelEMA(net_g, decay=0.999, update_every=1)   # rank 0 only
+  ema.update(net_g, global_step)                      # after optim_g.step()
+  with ema.apply_to(net_g):
+    evaluate(...)
+"""
+from contextlib import contextmanager
+
+import torch
+
+
+def unwrap(model):
+    return model.module if hasattr(model, "module") else model
+
+
+class ModelEMA():
+    """
+    Keeps ema = decay * ema + (1 - decay) * weights over the model state dict
+    (parameters and floating point buffers), updated every update_every steps
+    with fused _foreach ops. decay applies per update.
+    """
+    def __init__(self, model, decay=0.999, update_every=1):
+        self.decay = decay
+        self.update_every = update_every
+        self.shadow = {k: v.detach().clone() for k, v in unwrap(model).state_dict().items()}
+        self.float_keys = [k for k, v in self.shadow.items() if v.is_floating_point()]
+        self.other_keys = [k for k, v in self.shadow.items() if not v.is_floating_point()]
+
+    @torch.no_grad()
+    def update(self, model, step):
+        if step % self.update_every != 0:
+            return
+        state = unwrap(model).state_dict()
+        torch._foreach_lerp_([self.shadow[k] for k in self.float_keys],
+                             [state[k].detach() for k in self.float_keys], 1. - self.decay)
+        for k in self.other_keys:
+            self.shadow[k].copy_(state[k])
+
+    def state_dict(self):
+        return self.shadow
+
+    def load_state_dict(self, state_dict):
+        for k, v in self.shadow.items():
+            if k in state_dict:
+                v.copy_(state_dict[k])
+
+    @contextmanager
+    def apply_to(self, model):
+        """Temporarily loads the EMA weights into model"""
+        state = unwrap(model).state_dict()
+        backup = {k: v.detach().clone() for k, v in state.items()}
+        with torch.no_grad():
+            for k, v in state.items():
+                v.copy_(self.shadow[k])
+        try:
+            yield model
+        finally:
+            with torch.no_grad():
+                for k, v in state.items():
+                    v.copy_(backup[k])
@@ -6,12 +6,6 @@ from torch import nn
 import torch.nn.functional as F
 import torch.utils.data
 import numpy as np
-import librosa
-import librosa.util as librosa_util
-from librosa.util import normalize, pad_center, tiny
-from scipy.signal import get_window
-from scipy.io.wavfile import read
-from librosa.filters import mel as librosa_mel_fn
 
 MAX_WAV_VALUE = 32768.0
 
@@ -70,6 +64,12 @@ def spectrogram_torch(y, n_fft, sampling_rate, hop_size, win_size, center=False)
     return spec
 
 
+def librosa_mel_fn(**kwargs):
+    # librosa (and numba) load with the first mel basis, not with the module
+    from librosa.filters import mel
+    return mel(**kwargs)
+
+
 def spec_to_mel_torch(spec, n_fft, num_mels, sampling_rate, fmin, fmax):
     global mel_basis
     dtype_device = str(spec.dtype) + '_' + str(spec.device)
@@ -0,0 +1,150 @@
+"""
+Per-stage timing of the conversion path.
+
+  timer = StageTimer(device)
+  with timer.stage("content"):
+    c = get_content(cmodel, wav)
+  timer.attach(net_g.dec, "generator")     # times every forward of a module
+  timer.add_audio(seconds, frames)         # for real-time factor and frames/s
+  timer.summary(), timer.prometheus()
+"""
+import os
+import time
+import resource
+import threading
+from contextlib import contextmanager
+
+import torch
+
+
+def current_rss():
+    """Resident set size of this process in bytes (Linux), peak RSS elsewhere"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class PeakRSS():
+    """
+    Peak resident memory within a block, sampled by a background thread
+    (ru_maxrss only ever grows, so it cannot attribute memory to one stage).
+
+      with PeakRSS() as rss:
+        ...
+      rss.peak, rss.peak - rss.start
+    """
+    def __init__(self, interval=0.001):
+        self.interval = interval
+        self.start = self.peak = 0
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __enter__(self):
+        self.start = self.peak = current_rss()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss())
+        return False
+
+
+class StageTimer():
+    """
+    Records per stage: calls, wall time, peak memory
+    (CUDA: peak allocated during the stage, CPU: peak RSS sampled during the stage by PeakRSS).
+
+    callback: optional fn(stage, seconds, peak_memory_bytes) called after every stage
+    """
+    def __init__(self, device="cpu", callback=None):
+        self.device = torch.device(device)
+        self.callback = callback
+        self.stages = {}
+        self.audio_seconds = 0.
+        self.frames = 0
+        self._start = {}
+        self._rss = {}
+
+    def _sync(self):
+        if self.device.type == "cuda":
+            torch.cuda.synchronize(self.device)
+
+    def _begin(self, name):
+        self._sync()
+        if self.device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(self.device)
+        else:
+            self._rss[name] = PeakRSS().__enter__()
+        self._start[name] = time.perf_counter()
+
+    def _end(self, name):
+        self._sync()
+        seconds = time.perf_counter() - self._start.pop(name)
+        if self.device.type == "cuda":
+            peak_memory = torch.cuda.max_memory_allocated(self.device)
+        else:
+            rss = self._rss.pop(name)
+            rss.__exit__(None, None, None)
+            peak_memory = rss.peak
+
+        stats = self.stages.setdefault(name, {"calls": 0, "seconds": 0., "peak_memory_bytes": 0})
+        stats["calls"] += 1
+        stats["seconds"] += seconds
+        stats["peak_memory_bytes"] = max(stats["peak_memory_bytes"], peak_memory)
+        if self.callback is not None:
+            self.callback(name, seconds, peak_memory)
+
+    @contextmanager
+    def stage(self, name):
+        self._begin(name)
+        try:
+            yield
+        finally:
+            self._end(name)
+
+    def attach(self, module, name):
+        """Times every forward call of module as stage name"""
+        pre = module.register_forward_pre_hook(lambda m, inputs: self._begin(name))
+        post = module.register_forward_hook(lambda m, inputs, output: self._end(name))
+        return pre, post
+
+    def add_audio(self, seconds, frames):
+        """Source audio converted, for real-time factor and frames per second"""
+        self.audio_seconds += seconds
+        self.frames += frames
+
+    def summary(self):
+        summary = {}
+        for name, stats in self.stages.items():
+            seconds = stats["seconds"]
+            summary[name] = dict(stats)
+            summary[name]["rtf"] = seconds / self.audio_seconds if self.audio_seconds else None
+            summary[name]["frames_per_second"] = self.frames / seconds if seconds else None
+        return summary
+
+    def prometheus(self, prefix="linearvc"):
+        lines = [
+            "{}_audio_seconds_total {}".format(prefix, self.audio_seconds),
+            "{}_frames_total {}".format(prefix, self.frames),
+        ]
+        for name, stats in self.summary().items():
+            for key, metric in (("calls", "stage_calls_total"), ("seconds", "stage_seconds_total"),
+                                ("peak_memory_bytes", "stage_peak_memory_bytes"), ("rtf", "stage_rtf"),
+                                ("frames_per_second", "stage_frames_per_second")):
+                if stats[key] is not None:
+                    lines.append('{}_{}{{stage="{}"}} {}'.format(prefix, metric, name, stats[key]))
+        return "\n".join(lines) + "\n"
+
+    def reset(self):
+        self.stages = {}
+        self.audio_seconds = 0.
+        self.frames = 0
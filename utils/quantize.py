@@ -0,0 +1,165 @@
+"""
+int8 quantization of the WavLM content encoder for CPU serving.
+
+  - nn.Linear layers (q/k/v/out projections, fc1/fc2, ...) : dynamic int8
+  - ConvFeatureExtractionModel convs (optional)             : static int8, calibrated
+
+Running this file produces an accuracy report of the quantized encoder
+against float (layer features and downstream VQ code assignments).
+"""
+import os
+import time
+import json
+import argparse
+from glob import glob
+
+import torch
+from torch import nn
+from torch.nn import functional as F
+from torch.ao import quantization as tq
+
+from wavlm import WavLM, WavLMConfig
+
+
+class StaticQuantConv(nn.Module):
+    """Wraps a float conv with quant/dequant stubs so that only the conv
+    itself runs in int8 and the surrounding norm/GELU stay in float."""
+    def __init__(self, conv):
+        super().__init__()
+        self.quant = tq.QuantStub()
+        self.conv = conv
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.conv(self.quant(x)))
+
+
+def quantize_feature_extractor(feature_extractor, calib_wavs):
+    """Static int8 quantization of the conv front end, in place.
+
+    calib_wavs: list of (1, T) float tensors used to calibrate the observers
+    """
+    assert feature_extractor.conv_type == "default", "only the default conv extractor is supported"
+    qconfig = tq.get_default_qconfig(torch.backends.quantized.engine)
+    for block in feature_extractor.conv_layers:
+        block[0] = StaticQuantConv(block[0])
+        block[0].qconfig = qconfig
+    tq.prepare(feature_extractor, inplace=True)
+    with torch.no_grad():
+        for wav in calib_wavs:
+            feature_extractor(wav)
+    tq.convert(feature_extractor, inplace=True)
+    return feature_extractor
+
+
+def quantize_cmodel(cmodel, static_conv=False, calib_wavs=None):
+    """Returns an int8 copy of the content model on CPU.
+
+    The float model is left untouched so that both can be compared.
+    """
+    # rebuilt rather than deepcopied: the weight-normed pos_conv is not copyable
+    qmodel = WavLM(cmodel.cfg)
+    if cmodel.prepared:
+        qmodel.prepare_for_inference()
+    qmodel.load_state_dict(cmodel.state_dict())
+    qmodel.set_attention_backend(cmodel.attention_backend, cmodel.attention_chunk_size)
+    qmodel.eval()
+    if static_conv:
+        assert calib_wavs, "static conv quantization needs calibration audio"
+        quantize_feature_extractor(qmodel.feature_extractor, [w.cpu() for w in calib_wavs])
+    qmodel = tq.quantize_dynamic(qmodel, {nn.Linear}, dtype=torch.qint8, inplace=True)
+    return qmodel
+
+
+def vq_codes(c, codebook):
+    """Code indices (B, T) assigned by VQEmbeddingEMA to content c (B, D, T)."""
+    _, encodings = codebook.L2_distance(c.transpose(1, 2), codebook.embedding)
+    return encodings.argmax(-1).view(c.size(0), -1)
+
+
+def quantization_report(cmodel, qmodel, wavs, layer=6, codebook=None):
+    """Compares layer features of the quantized content model against float.
+
+    wavs: list of (name, (1, T) cpu tensor)
+    codebook: optional VQEmbeddingEMA, to also compare code assignments
+    """
+    from utils.utils import get_content
+
+    rows = []
+    for name, wav in wavs:
+        start = time.perf_counter()
+        c_ref = get_content(cmodel, wav, layer=layer)
+        time_fp32 = time.perf_counter() - start
+
+        start = time.perf_counter()
+        c_q = get_content(qmodel, wav, layer=layer)
+        time_int8 = time.perf_counter() - start
+
+        diff = c_q - c_ref
+        row = {
+            "name": name,
+            "frames": c_ref.size(-1),
+            "rel_l2": (diff.norm() / c_ref.norm()).item(),
+            "cosine": F.cosine_similarity(c_ref, c_q, dim=1).mean().item(),
+            "max_abs": diff.abs().max().item(),
+            "time_fp32": time_fp32,
+            "time_int8": time_int8,
+        }
+        if codebook is not None:
+            row["code_agreement"] = (vq_codes(c_ref, codebook) == vq_codes(c_q, codebook)).float().mean().item()
+        rows.append(row)
+
+    summary = {}
+    for key in rows[0]:
+        if key in ("name", "frames"):
+            continue
+        summary[key] = sum(r[key] for r in rows) / len(rows)
+    summary["speedup"] = sum(r["time_fp32"] for r in rows) / sum(r["time_int8"] for r in rows)
+    return {"layer": layer, "summary": summary, "utterances": rows}
+
+
+if __name__ == "__main__":
+    from utils import audio
+    from modules.modules_v9_new import VQEmbeddingEMA
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--wavlm_path", type=str, default="/home/yjsim/VoiceConversion/ICASSP2025/wavlm/WavLM-Large.pt", help="path to WavLM checkpoint")
+    parser.add_argument("--codebook_path", type=str, default=None, help="path to codebook .pt, to compare VQ code assignments")
+    parser.add_argument("--wav_dir", type=str, default="./data_sample/VCTK", help="path to wav dir (speaker/*.wav)")
+    parser.add_argument("--num_wavs", type=int, default=20, help="number of evaluation utterances")
+    parser.add_argument("--num_calib", type=int, default=8, help="number of calibration utterances for --static_conv")
+    parser.add_argument("--static_conv", default=False, action="store_true", help="also quantize the conv feature extractor")
+    parser.add_argument("--layer", type=int, default=6, help="WavLM layer to compare")
+    parser.add_argument("--sr", type=int, default=16000, help="sampling rate")
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--out", type=str, default="./quantization_report.json", help="path to output json")
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    checkpoint = torch.load(args.wavlm_path, map_location="cpu")
+    cmodel = WavLM(WavLMConfig(checkpoint["cfg"]))
+    cmodel.load_state_dict(checkpoint["model"])
+    cmodel.eval()
+
+    codebook = None
+    if args.codebook_path is not None:
+        embedding = torch.load(args.codebook_path, map_location="cpu")
+        codebook = VQEmbeddingEMA(embedding.size(0), embedding.size(1), codebook_custom=embedding)
+
+    filenames = sorted(glob(f"{args.wav_dir}/*/*.wav"))
+    calib_files = filenames[:args.num_calib]
+    eval_files = filenames[args.num_calib:args.num_calib + args.num_wavs]
+
+    def load(filename):
+        wav, _ = audio.load(filename, sr=args.sr)
+        return torch.from_numpy(wav).unsqueeze(0)
+
+    qmodel = quantize_cmodel(cmodel, static_conv=args.static_conv, calib_wavs=[load(f) for f in calib_files])
+    report = quantization_report(cmodel, qmodel, [(os.path.basename(f), load(f)) for f in eval_files], layer=args.layer, codebook=codebook)
+    report["static_conv"] = args.static_conv
+
+    with open(args.out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(json.dumps(report["summary"], indent=2))
@@ -6,15 +6,13 @@ import logging
 import json
 import subprocess
 import numpy as np
-from scipy.io.wavfile import read
 import torch
-import torchvision
 from torch.nn import functional as F
 # from utils.commons import sequence_mask
 # from utils.commons import sequence_mask
 
-import hifigan
-from wavlm import WavLM, WavLMConfig
+from utils.checkpoint import mmap_load
+from utils import audio
 
 MATPLOTLIB_FLAG = False
 
@@ -22,28 +20,57 @@ logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 logger = logging
 
 
-def get_cmodel(rank):
-    checkpoint = torch.load('/home/yjsim/VoiceConversion/ICASSP2025/wavlm/WavLM-Large.pt')
+def get_cmodel(rank, checkpoint_path='/home/yjsim/VoiceConversion/ICASSP2025/wavlm/WavLM-Large.pt', quantize=False, attention="default", prepare=True):
+    from wavlm import WavLM, WavLMConfig
+    checkpoint = mmap_load(checkpoint_path)
     cfg = WavLMConfig(checkpoint['cfg'])
-    cmodel = WavLM(cfg).cuda(rank)
-    cmodel.load_state_dict(checkpoint['model'])
+    # built on the meta device: no random init, the parameters are the
+    # memory-mapped checkpoint tensors (assign=True)
+    with torch.device("meta"):
+      cmodel = WavLM(cfg)
+    if checkpoint.get('prepared', False):
+      # saved by python -m utils.checkpoint --cmodel
+      cmodel.prepare_for_inference()
+      cmodel.load_state_dict(checkpoint['model'], assign=True)
+    else:
+      cmodel.load_state_dict(checkpoint['model'], assign=True)
+      if prepare:
+        cmodel.prepare_for_inference()
     cmodel.eval()
-    return cmodel
+    # chunked: attention memory linear in the input length (long recordings)
+    cmodel.set_attention_backend(attention)
+    if quantize:
+      # dynamic int8 kernels only run on CPU
+      from utils.quantize import quantize_cmodel
+      return quantize_cmodel(cmodel)
+    return cmodel.to(rank)
     
     
-def get_content(cmodel, y, layer=None):
+def get_content(cmodel, y, layer=None, padding_mask=None, weights=None):
+    """
+    content features (B, C, T) of WavLM layer `layer` (final output if None)
+    layer: a list extracts several layers in one pass, returned as a list, or
+      summed with weights
+    """
     with torch.no_grad():
       if layer == None:
-        c = cmodel.extract_features(y.squeeze(1))[0]
+        c = cmodel.extract_features(y.squeeze(1), padding_mask=padding_mask)[0]
         c = c.transpose(1,2)
       else:
-        rep, layer_results = cmodel.extract_features(y.squeeze(1), output_layer=layer, ret_layer_results=True)[0]
-        c = [x.transpose(0, 1) for x, _ in layer_results]
-        c = c[-1].transpose(1, 2)
+        # only the requested layers are kept alive, not every layer below them
+        layers = layer if isinstance(layer, (list, tuple)) else [layer]
+        c, _ = cmodel.extract_layers(y.squeeze(1), layers, padding_mask=padding_mask, weights=weights)
+        if weights is not None:
+          c = c.transpose(1, 2)
+        elif isinstance(layer, (list, tuple)):
+          c = [x.transpose(1, 2) for x in c]
+        else:
+          c = c[0].transpose(1, 2)
     return c
 
 
 def get_vocoder(rank):
+    import hifigan
     with open("/home/sim/VoiceConversion/FreeVC/hifigan/config.json", "r") as f:
         config = json.load(f)
     config = hifigan.AttrDict(config)
@@ -60,6 +87,7 @@ def transform(mel, height): # 68-92
     #r = np.random.random()
     #rate = r * 0.3 + 0.85 # 0.85-1.15
     #height = int(mel.size(-2) * rate)
+    import torchvision
     tgt = torchvision.transforms.functional.resize(mel, (height, mel.size(-1)))
     if height >= mel.size(-2):
         return tgt[:, :mel.size(-2), :]
@@ -70,12 +98,14 @@ def transform(mel, height): # 68-92
         
         
 def stretch(mel, width): # 0.5-2
+    import torchvision
     return torchvision.transforms.functional.resize(mel, (mel.size(-2), width))
 
 
 def load_checkpoint(checkpoint_path, model, optimizer=None, strict=False):
   assert os.path.isfile(checkpoint_path)
-  checkpoint_dict = torch.load(checkpoint_path, map_location='cpu')
+  # memory-mapped: the optimizer state is not read when optimizer is None
+  checkpoint_dict = mmap_load(checkpoint_path)
   iteration = checkpoint_dict['iteration']
   learning_rate = checkpoint_dict['learning_rate']
   if optimizer is not None:
@@ -191,8 +221,10 @@ def plot_alignment_to_numpy(alignment, info=None):
 
 
 def load_wav_to_torch(full_path):
-  sampling_rate, data = read(full_path)
-  return torch.FloatTensor(data.astype(np.float32)), sampling_rate
+  # int16 scale, as scipy's read of the 16-bit training wavs (divided by max_wav_value)
+  data, sampling_rate = audio.load(full_path)
+  data *= 32768.0
+  return torch.from_numpy(data), sampling_rate
 
 
 def load_filepaths_and_text(filename, split="|"):
@@ -318,5 +350,8 @@ class HParams():
   def __contains__(self, key):
     return key in self.__dict__
 
+  def get(self, key, default=None):
+    return self.__dict__.get(key, default)
+
   def __repr__(self):
     return self.__dict__.__repr__()
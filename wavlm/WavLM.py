@@ -18,6 +18,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import LayerNorm
 from wavlm.modules import (
+    ATTENTION_BACKENDS,
     Fp32GroupNorm,
     Fp32LayerNorm,
     GradMultiply,
@@ -227,6 +228,7 @@ class WavLM(nn.Module):
 
         self.cfg = cfg
         feature_enc_layers = eval(cfg.conv_feature_layers)
+        self.feature_enc_layers = feature_enc_layers
         self.embed = feature_enc_layers[-1][0]
 
         self.feature_extractor = ConvFeatureExtractionModel(
@@ -268,9 +270,14 @@ class WavLM(nn.Module):
         self.encoder = TransformerEncoder(cfg)
         self.layer_norm = LayerNorm(self.embed)
 
+        self.attention_backend = "default"
+        self.attention_chunk_size = 256
+        self.prepared = False
+
     def apply_mask(self, x, padding_mask):
         B, T, C = x.shape
         if self.mask_prob > 0:
+            assert self.mask_emb is not None, "masking was removed by prepare_for_inference"
             mask_indices = compute_mask_indices(
                 (B, T),
                 padding_mask,
@@ -308,18 +315,51 @@ class WavLM(nn.Module):
         
         return x, mask_indices
 
+    def set_attention_backend(self, backend="default", chunk_size=256):
+        """Attention of every encoder layer: default / sdpa / chunked (see MultiheadAttention)"""
+        assert backend in ATTENTION_BACKENDS, "unknown attention backend {}".format(backend)
+        self.attention_backend = backend
+        self.attention_chunk_size = chunk_size
+        for module in self.modules():
+            if isinstance(module, MultiheadAttention):
+                module.attention_backend = backend
+                module.attention_chunk_size = chunk_size
+        return self
+
+    def prepare_for_inference(self):
+        """
+        Simplifies the model for inference, in place:
+          - folds the weight norm of pos_conv into its weight
+          - fuses q / k / v of every layer into one qkv_proj
+          - replaces dropout by identities, removes mask_emb and the
+            feature_grad_mult copy of the conv features
+        The state_dict keys change: utils.checkpoint --cmodel saves the
+        result, utils.get_cmodel loads either kind of checkpoint.
+        """
+        if self.prepared:
+            return self
+        nn.utils.remove_weight_norm(self.encoder.pos_conv[0])
+        for module in list(self.modules()):
+            if isinstance(module, MultiheadAttention):
+                module.fuse_qkv()
+            for name, child in module.named_children():
+                if isinstance(child, nn.Dropout):
+                    setattr(module, name, nn.Identity())
+        self.register_parameter("mask_emb", None)
+        self.feature_grad_mult = 1.0
+        self.prepared = True
+        return self.eval()
+
     def forward_padding_mask(
             self, features: torch.Tensor, padding_mask: torch.Tensor,
     ) -> torch.Tensor:
-        extra = padding_mask.size(1) % features.size(1)
-        if extra > 0:
-            padding_mask = padding_mask[:, :-extra]
-        padding_mask = padding_mask.view(
-            padding_mask.size(0), features.size(1), -1
-        )
-        #padding_mask = padding_mask.all(-1)
-        padding_mask = padding_mask.any(-1)
-        return padding_mask
+        # frames past the ones the unpadded samples give on their own (valid conv
+        # arithmetic) are padding, so a padded item keeps exactly its unbatched frames
+        lengths = (~padding_mask).sum(-1)
+        for _, kernel_size, stride in self.feature_enc_layers:
+            lengths = torch.div(lengths - kernel_size, stride, rounding_mode="floor") + 1
+        frames = torch.arange(features.size(1), device=features.device)
+        return frames[None, :] >= lengths[:, None]
 
     def extract_features(
         self,
@@ -329,14 +369,15 @@ class WavLM(nn.Module):
         ret_conv: bool = False,
         output_layer: Optional[int] = None,
         ret_layer_results: bool = False,
+        keep_layers: Optional[List[int]] = None,
     ):
         if self.feature_grad_mult > 0:
-            features = self.feature_extractor(source)
+            features = self.feature_extractor(source, padding_mask)
             if self.feature_grad_mult != 1.0:
                 features = GradMultiply.apply(features, self.feature_grad_mult)
         else:
             with torch.no_grad():
-                features = self.feature_extractor(source)
+                features = self.feature_extractor(source, padding_mask)
 
         features = features.transpose(1, 2)
         features = self.layer_norm(features)
@@ -364,7 +405,8 @@ class WavLM(nn.Module):
         x, layer_results = self.encoder(
             x,
             padding_mask=padding_mask,
-            layer=None if output_layer is None else output_layer - 1
+            layer=None if output_layer is None else output_layer - 1,
+            keep_layers=keep_layers,
         )
         
         res = {"x": x, "padding_mask": padding_mask, "features": features, "layer_results": layer_results}
@@ -374,6 +416,38 @@ class WavLM(nn.Module):
             feature = (feature, res["layer_results"])
         return feature, res["padding_mask"]
 
+    def extract_layers(
+        self,
+        source: torch.Tensor,
+        layers: List[int],
+        padding_mask: Optional[torch.Tensor] = None,
+        weights: Optional[List[float]] = None,
+    ):
+        """
+        Outputs (B, T, C) of the encoder layers `layers` (numbered as output_layer,
+        from 1) in one pass up to max(layers). Other layer outputs are not kept.
+        Returns (list in the order of layers, padding_mask), or with weights
+        (sum of weight * layer output, padding_mask).
+        """
+        layers = list(layers)
+        num_layers = len(self.encoder.layers)
+        invalid = [n for n in layers if not 1 <= n <= num_layers]
+        if not layers or invalid:
+            raise ValueError("layers must be in 1..{}, got {}".format(num_layers, layers))
+        (_, layer_results), padding_mask = self.extract_features(
+            source,
+            padding_mask=padding_mask,
+            output_layer=max(layers),
+            ret_layer_results=True,
+            keep_layers=layers,
+        )
+        outputs = {n: x.transpose(0, 1) for n, (x, _) in zip(sorted(set(layers)), layer_results)}
+        features = [outputs[n] for n in layers]
+        if weights is not None:
+            assert len(weights) == len(layers), "one weight per layer"
+            return sum(w * f for w, f in zip(weights, features)), padding_mask
+        return features, padding_mask
+
 
 class ConvFeatureExtractionModel(nn.Module):
     def __init__(
@@ -497,12 +571,35 @@ class ConvFeatureExtractionModel(nn.Module):
             x = x.view(x.size(0), -1, x.size(-1))
         else:
             for conv in self.conv_layers:
-                x = conv(x)
+                if mask is not None and isinstance(conv, nn.Sequential) and isinstance(conv[2], Fp32GroupNorm):
+                    x = self.masked_group_norm_block(conv, x, mask)
+                else:
+                    x = conv(x)
             if self.conv_type == "conv2d":
                 b, c, t, f = x.size()
                 x = x.transpose(2, 3).contiguous().view(b, c * f, t)
         return x
 
+    @staticmethod
+    def masked_group_norm_block(block, x, mask):
+        """conv -> dropout -> group norm -> gelu with the norm statistics taken over
+        the unpadded frames only (mask: B x T samples, True = padding), so a padded
+        item in a batch gets the same features as on its own"""
+        conv, dropout, norm, act = block
+        x = dropout(conv(x))
+        lengths = ((~mask).sum(-1) - conv.kernel_size[0]).div(conv.stride[0], rounding_mode="floor") + 1
+        valid = torch.arange(x.size(-1), device=x.device) < lengths.clamp(min=1)[:, None]
+        valid = valid[:, None, None, :].float()
+        b, c, t = x.size()
+        xf = x.float().view(b, norm.num_groups, -1, t)
+        count = valid.sum(-1, keepdim=True) * xf.size(2)
+        mean = (xf * valid).sum((2, 3), keepdim=True) / count
+        var = ((xf - mean) ** 2 * valid).sum((2, 3), keepdim=True) / count
+        xf = ((xf - mean) / torch.sqrt(var + norm.eps)).view(b, c, t)
+        if norm.affine:
+            xf = xf * norm.weight.float()[:, None] + norm.bias.float()[:, None]
+        return act(xf.type_as(x))
+
 
 class TransformerEncoder(nn.Module):
     def __init__(self, args):
@@ -561,15 +658,16 @@ class TransformerEncoder(nn.Module):
 
         self.apply(init_bert_params)
 
-    def forward(self, x, padding_mask=None, streaming_mask=None, layer=None):
-        x, layer_results = self.extract_features(x, padding_mask, streaming_mask, layer)
+    def forward(self, x, padding_mask=None, streaming_mask=None, layer=None, keep_layers=None):
+        x, layer_results = self.extract_features(x, padding_mask, streaming_mask, layer, keep_layers)
         
         if self.layer_norm_first and layer is None:
             x = self.layer_norm(x)
 
         return x, layer_results
 
-    def extract_features(self, x, padding_mask=None, streaming_mask=None, tgt_layer=None):
+    def extract_features(self, x, padding_mask=None, streaming_mask=None, tgt_layer=None, keep_layers=None):
+        """keep_layers: layer numbers (i + 1) kept in layer_results, None keeps the input and every layer"""
 
         if padding_mask is not None:
             x[padding_mask] = 0
@@ -588,7 +686,7 @@ class TransformerEncoder(nn.Module):
 
         layer_results = []
         z = None
-        if tgt_layer is not None:
+        if tgt_layer is not None and keep_layers is None:
             layer_results.append((x, z))
         r = None
         pos_bias = None
@@ -597,7 +695,7 @@ class TransformerEncoder(nn.Module):
             if not self.training or (dropout_probability > self.layerdrop):
                 x, z, pos_bias = layer(x, self_attn_padding_mask=padding_mask, need_weights=False,
                                        self_attn_mask=streaming_mask, pos_bias=pos_bias)
-            if tgt_layer is not None:
+            if tgt_layer is not None and (keep_layers is None or i + 1 in keep_layers):
                 layer_results.append((x, z))
             if i == tgt_layer:
                 r = x
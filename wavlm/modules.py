@@ -180,6 +180,9 @@ def init_bert_params(module):
     """
 
     def normal_(data):
+        if data.is_meta:
+            # built on the meta device to be loaded with assign=True
+            return
         # with FSDP, module params will be on CUDA, so we cast them back to CPU
         # so that the RNG is consistent with and without FSDP
         data.copy_(
@@ -300,10 +303,33 @@ def quant_noise(module, p, block_size):
     return module
 
 
+ATTENTION_BACKENDS = ("default", "sdpa", "chunked")
+
+
+class RelativePositionBias():
+    """Relative position bias (num_heads, tgt_len, src_len) of a MultiheadAttention,
+    computed for blocks of query rows so the full table is never materialised."""
+
+    def __init__(self, attention, tgt_len, src_len):
+        self.attention = attention
+        self.tgt_len = tgt_len
+        self.src_len = src_len
+
+    def rows(self, start, end):
+        """bias of query rows [start, end): (num_heads, end - start, src_len)"""
+        return self.attention.compute_bias(self.tgt_len, self.src_len, start, end)
+
+
 class MultiheadAttention(nn.Module):
     """Multi-headed attention.
 
     See "Attention Is All You Need" for more details.
+
+    attention_backend (self-attention without incremental state):
+        default: F.multi_head_attention_forward, materialises the (tgt_len, src_len) scores
+        sdpa: F.scaled_dot_product_attention with the relative position bias as mask
+        chunked: sdpa over blocks of attention_chunk_size queries, the bias is built
+            per block, memory grows linearly with the input length
     """
 
     def __init__(
@@ -334,12 +360,17 @@ class MultiheadAttention(nn.Module):
 
         self.num_heads = num_heads
         self.dropout_module = nn.Dropout(dropout)
+        self.attention_backend = "default"
+        self.attention_chunk_size = 256
 
         self.has_relative_attention_bias = has_relative_attention_bias
         self.num_buckets = num_buckets
         self.max_distance = max_distance
         if self.has_relative_attention_bias:
             self.relative_attention_bias = nn.Embedding(num_buckets, num_heads)
+            # 1-D bucket table of the relative positions -n..n per device, grown to the
+            # longest input seen (a few KB): bias rows are windows of it
+            self._bucket_cache = {}
 
         self.head_dim = embed_dim // num_heads
         self.q_head_dim = self.head_dim
@@ -376,6 +407,8 @@ class MultiheadAttention(nn.Module):
         self.out_proj = quant_noise(
             nn.Linear(embed_dim, embed_dim, bias=bias), q_noise, qn_block_size
         )
+        # q / k / v in one projection, set by fuse_qkv (inference)
+        self.qkv_proj = None
 
         if add_bias_kv:
             self.bias_k = Parameter(torch.Tensor(1, 1, embed_dim))
@@ -414,6 +447,29 @@ class MultiheadAttention(nn.Module):
         if self.has_relative_attention_bias:
             nn.init.xavier_normal_(self.relative_attention_bias.weight)
 
+    def fuse_qkv(self):
+        """Replaces q_proj / k_proj / v_proj by one (3 * embed_dim) qkv_proj, in place (inference)"""
+        assert self.self_attention and self.qkv_same_dim, "only self-attention projections can be fused"
+        if self.qkv_proj is not None:
+            return
+        projections = (self.q_proj, self.k_proj, self.v_proj)
+        weight = self.q_proj.weight
+        qkv_proj = nn.Linear(self.embed_dim, 3 * self.embed_dim, device=weight.device, dtype=weight.dtype)
+        with torch.no_grad():
+            qkv_proj.weight.copy_(torch.cat([p.weight for p in projections]))
+            # k_proj has no bias with rescale_init
+            qkv_proj.bias.copy_(torch.cat([
+                p.bias if p.bias is not None else torch.zeros_like(p.weight[:, 0]) for p in projections
+            ]))
+        del self.q_proj, self.k_proj, self.v_proj
+        self.qkv_proj = qkv_proj
+
+    def _in_proj(self, query):
+        """q, k, v projections of query (self-attention)"""
+        if self.qkv_proj is not None:
+            return self.qkv_proj(query).chunk(3, dim=-1)
+        return self.q_proj(query), self.k_proj(query), self.v_proj(query)
+
     def _relative_positions_bucket(self, relative_positions, bidirectional=True):
         num_buckets = self.num_buckets
         max_distance = self.max_distance
@@ -441,18 +497,29 @@ class MultiheadAttention(nn.Module):
         relative_buckets += torch.where(is_small, relative_positions, relative_postion_if_large)
         return relative_buckets
 
-    def compute_bias(self, query_length, key_length):
-        context_position = torch.arange(query_length, dtype=torch.long)[:, None]
-        memory_position = torch.arange(key_length, dtype=torch.long)[None, :]
-        relative_position = memory_position - context_position
-        relative_position_bucket = self._relative_positions_bucket(
-            relative_position,
-            bidirectional=True
+    def relative_position_buckets(self, min_position, max_position, device):
+        """Buckets (int32) of the relative positions min_position..max_position, a window of the cached table"""
+        n = max(-min_position, max_position)
+        table = self._bucket_cache.get(str(device))
+        if table is None or table.size(0) < 2 * n + 1:
+            relative_position = torch.arange(-n, n + 1, dtype=torch.long)
+            table = self._relative_positions_bucket(relative_position, bidirectional=True)
+            table = table.to(device, torch.int32)
+            self._bucket_cache[str(device)] = table
+        center = table.size(0) // 2
+        return table[center + min_position:center + max_position + 1]
+
+    def compute_bias(self, query_length, key_length, start=0, end=None):
+        """Relative position bias (num_heads, query_length, key_length) of the query rows
+        [start, end) (default all), broadcast over the batch"""
+        end = query_length if end is None else end
+        # bias[i, j] depends on j - i only: one value per relative position, and row i is
+        # the window starting at end - 1 - i (unfold views the windows, flip orders them)
+        relative_position_bucket = self.relative_position_buckets(
+            -(end - 1), key_length - 1 - start, self.relative_attention_bias.weight.device
         )
-        relative_position_bucket = relative_position_bucket.to(self.relative_attention_bias.weight.device)
-        values = self.relative_attention_bias(relative_position_bucket)
-        values = values.permute([2, 0, 1])
-        return values
+        values = self.relative_attention_bias(relative_position_bucket).t()
+        return values.unfold(1, key_length, 1).flip(1)
 
     def forward(
             self,
@@ -502,8 +569,12 @@ class MultiheadAttention(nn.Module):
                 assert src_len, bsz == value.shape[:2]
 
         if self.has_relative_attention_bias and position_bias is None:
-            position_bias = self.compute_bias(tgt_len, src_len)
-            position_bias = position_bias.unsqueeze(0).repeat(bsz, 1, 1, 1).view(bsz * self.num_heads, tgt_len, src_len)
+            # (num_heads, tgt_len, src_len), not repeated bsz times: every use
+            # below broadcasts it against (bsz, num_heads, tgt_len, src_len)
+            if self.attention_backend == "chunked":
+                position_bias = RelativePositionBias(self, tgt_len, src_len)
+            else:
+                position_bias = self.compute_bias(tgt_len, src_len)
 
         if (
                 not is_tpu  # don't use PyTorch version on TPUs
@@ -517,6 +588,13 @@ class MultiheadAttention(nn.Module):
             assert key is not None and value is not None
             assert attn_mask is None
 
+            if self.attention_backend != "default" and self.self_attention and not need_weights:
+                x = self._sdpa_attention(query, key_padding_mask, position_bias)
+                return x, None, position_bias
+
+            if isinstance(position_bias, RelativePositionBias):
+                position_bias = position_bias.rows(0, tgt_len)
+
             attn_mask_rel_pos = None
             if position_bias is not None:
                 attn_mask_rel_pos = position_bias
@@ -530,9 +608,44 @@ class MultiheadAttention(nn.Module):
                     gate_a, gate_b = torch.sigmoid(self.grep_linear(query_layer).view(
                         _B, _H, _L, 2, 4).sum(-1, keepdim=False)).chunk(2, dim=-1)
                     gate_a_1 = gate_a * (gate_b * self.grep_a - 1.0) + 2.0
-                    attn_mask_rel_pos = gate_a_1.view(bsz * self.num_heads, -1, 1) * position_bias
+                    attn_mask_rel_pos = gate_a_1 * position_bias
+
+            if not isinstance(self.qkv_proj if self.qkv_proj is not None else self.q_proj, nn.Linear):
+                # quantized projections have no float weight to hand to
+                # F.multi_head_attention_forward, so call them as modules
+                x, attn = self._module_attention(
+                    query, key_padding_mask, need_weights, attn_mask_rel_pos
+                )
+                return x, attn, position_bias
+
+            if attn_mask_rel_pos is not None:
+                # F.multi_head_attention_forward takes a (bsz * num_heads, tgt_len, src_len) mask
+                attn_mask_rel_pos = attn_mask_rel_pos.expand(
+                    bsz, self.num_heads, tgt_len, src_len
+                ).reshape(-1, tgt_len, src_len)
+
+            if self.qkv_proj is not None:
+                x, attn = F.multi_head_attention_forward(
+                    query,
+                    key,
+                    value,
+                    self.embed_dim,
+                    self.num_heads,
+                    self.qkv_proj.weight,
+                    self.qkv_proj.bias,
+                    self.bias_k,
+                    self.bias_v,
+                    self.add_zero_attn,
+                    getattr(self.dropout_module, "p", 0.0),
+                    self.out_proj.weight,
+                    self.out_proj.bias,
+                    self.training,
+                    key_padding_mask,
+                    need_weights,
+                    attn_mask_rel_pos,
+                )
+                return x, attn, position_bias
 
-                attn_mask_rel_pos = attn_mask_rel_pos.view((-1, tgt_len, tgt_len))
             k_proj_bias = self.k_proj.bias
             if k_proj_bias is None:
                 k_proj_bias = torch.zeros_like(self.q_proj.bias)
@@ -563,6 +676,9 @@ class MultiheadAttention(nn.Module):
             )
             return x, attn, position_bias
 
+        if isinstance(position_bias, RelativePositionBias):
+            position_bias = position_bias.rows(0, tgt_len)
+
         if incremental_state is not None:
             saved_state = self._get_input_buffer(incremental_state)
             if saved_state is not None and "prev_key" in saved_state:
@@ -575,9 +691,7 @@ class MultiheadAttention(nn.Module):
             saved_state = None
 
         if self.self_attention:
-            q = self.q_proj(query)
-            k = self.k_proj(query)
-            v = self.v_proj(query)
+            q, k, v = self._in_proj(query)
         elif self.encoder_decoder_attention:
             # encoder-decoder attention
             q = self.q_proj(query)
@@ -734,11 +848,10 @@ class MultiheadAttention(nn.Module):
                 gate_a, gate_b = torch.sigmoid(self.grep_linear(query_layer).view(
                     _B, _H, _L, 2, 4).sum(-1, keepdim=False)).chunk(2, dim=-1)
                 gate_a_1 = gate_a * (gate_b * self.grep_a - 1.0) + 2.0
-                position_bias = gate_a_1.view(bsz * self.num_heads, -1, 1) * position_bias
+                position_bias = gate_a_1 * position_bias
 
-            position_bias = position_bias.view(attn_weights.size())
-
-            attn_weights = attn_weights + position_bias
+            attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len) + position_bias
+            attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
 
         attn_weights_float = F.softmax(
             attn_weights, dim=-1
@@ -762,6 +875,117 @@ class MultiheadAttention(nn.Module):
 
         return attn, attn_weights, position_bias
 
+    def _module_attention(
+            self,
+            query: Tensor,
+            key_padding_mask: Optional[Tensor],
+            need_weights: bool,
+            attn_mask_rel_pos: Optional[Tensor],
+    ) -> Tuple[Tensor, Optional[Tensor]]:
+        """Self-attention equivalent to the F.multi_head_attention_forward
+        path, but with q/k/v/out projections invoked as modules.
+
+        Args:
+            query: input of shape `(tgt_len, bsz, embed_dim)`
+            attn_mask_rel_pos: gated relative position bias, broadcastable to
+                `(bsz, num_heads, tgt_len, src_len)`
+        """
+        tgt_len, bsz, embed_dim = query.size()
+
+        q, k, v = self._in_proj(query)
+        q = q * self.scaling
+
+        q = q.contiguous().view(tgt_len, bsz * self.num_heads, self.head_dim).transpose(0, 1)
+        k = k.contiguous().view(-1, bsz * self.num_heads, self.head_dim).transpose(0, 1)
+        v = v.contiguous().view(-1, bsz * self.num_heads, self.head_dim).transpose(0, 1)
+        src_len = k.size(1)
+
+        attn_weights = torch.bmm(q, k.transpose(1, 2)).view(bsz, self.num_heads, tgt_len, src_len)
+        if attn_mask_rel_pos is not None:
+            attn_weights = attn_weights + attn_mask_rel_pos
+
+        if key_padding_mask is not None:
+            attn_weights = attn_weights.masked_fill(
+                key_padding_mask.unsqueeze(1).unsqueeze(2).to(torch.bool),
+                float("-inf"),
+            )
+        attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
+
+        attn_weights_float = F.softmax(attn_weights, dim=-1)
+        attn_probs = self.dropout_module(attn_weights_float.type_as(attn_weights))
+
+        attn = torch.bmm(attn_probs, v)
+        attn = attn.transpose(0, 1).contiguous().view(tgt_len, bsz, embed_dim)
+        attn = self.out_proj(attn)
+
+        attn_weights: Optional[Tensor] = None
+        if need_weights:
+            attn_weights = attn_weights_float.view(
+                bsz, self.num_heads, tgt_len, src_len
+            ).mean(dim=1)
+        return attn, attn_weights
+
+    def _sdpa_attention(
+            self,
+            query: Tensor,
+            key_padding_mask: Optional[Tensor],
+            position_bias,
+    ) -> Tensor:
+        """Self-attention through F.scaled_dot_product_attention, equivalent to
+        the F.multi_head_attention_forward path. The chunked backend runs blocks
+        of attention_chunk_size queries and gates / builds the relative position
+        bias per block.
+
+        Args:
+            query: input of shape `(tgt_len, bsz, embed_dim)`
+            position_bias: ungated bias broadcastable to
+                `(bsz, num_heads, tgt_len, src_len)`, a RelativePositionBias or None
+        """
+        tgt_len, bsz, embed_dim = query.size()
+
+        q, k, v = self._in_proj(query)
+        q = q.reshape(tgt_len, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+        k = k.reshape(-1, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+        v = v.reshape(-1, bsz, self.num_heads, self.head_dim).permute(1, 2, 0, 3)
+        src_len = k.size(2)
+
+        gate_a_1 = None
+        if position_bias is not None and self.gru_rel_pos:
+            query_layer = query.transpose(0, 1).reshape(bsz, tgt_len, self.num_heads, -1).permute(0, 2, 1, 3)
+            gate_a, gate_b = torch.sigmoid(self.grep_linear(query_layer).view(
+                bsz, self.num_heads, tgt_len, 2, 4).sum(-1, keepdim=False)).chunk(2, dim=-1)
+            gate_a_1 = gate_a * (gate_b * self.grep_a - 1.0) + 2.0
+
+        padding = None
+        if key_padding_mask is not None:
+            padding = torch.zeros(bsz, 1, 1, src_len, dtype=q.dtype, device=q.device).masked_fill(
+                key_padding_mask.view(bsz, 1, 1, src_len).to(torch.bool), float("-inf")
+            )
+
+        chunk_size = self.attention_chunk_size if self.attention_backend == "chunked" else tgt_len
+        dropout_p = getattr(self.dropout_module, "p", 0.0) if self.training else 0.0
+        chunks = []
+        for start in range(0, tgt_len, chunk_size):
+            end = min(start + chunk_size, tgt_len)
+            mask = None
+            if position_bias is not None:
+                if isinstance(position_bias, RelativePositionBias):
+                    mask = position_bias.rows(start, end)
+                else:
+                    mask = position_bias[..., start:end, :]
+                if gate_a_1 is not None:
+                    mask = gate_a_1[:, :, start:end] * mask
+                mask = mask.to(q.dtype)
+            if padding is not None:
+                mask = padding if mask is None else mask + padding
+            chunks.append(F.scaled_dot_product_attention(
+                q[:, :, start:end], k, v, attn_mask=mask, dropout_p=dropout_p
+            ))
+
+        attn = torch.cat(chunks, dim=2) if len(chunks) > 1 else chunks[0]
+        attn = attn.permute(2, 0, 1, 3).reshape(tgt_len, bsz, embed_dim)
+        return self.out_proj(attn)
+
     @staticmethod
     def _append_prev_key_padding_mask(
             key_padding_mask: Optional[Tensor],